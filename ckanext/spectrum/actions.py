@@ -1,17 +1,187 @@
+import contextlib
+import datetime
+import itertools
+import json
 import logging
-import random
 import re
 import secrets
+import threading
+import time
 
+import sqlalchemy as sa
+
+import ckan.authz as authz
+import ckan.lib.dictization as dictization
+import ckan.lib.jobs as jobs
+import ckan.lib.search as search
+import ckan.plugins as plugins
 import ckan.plugins.toolkit as toolkit
+import ckanext.spectrum.activity as spectrum_activity
+import ckanext.spectrum.authn as spectrum_authn
+import ckanext.spectrum.authz as spectrum_authz
+import ckanext.spectrum.jobs as spectrum_jobs
+import ckanext.spectrum.lfs as spectrum_lfs
+import ckanext.spectrum.upload as spectrum_upload
 from ckan.plugins.toolkit import ValidationError, _
 from ckan.logic import NotFound
+from ckan.logic.validators import tag_length_validator, tag_name_validator
+from ckanext.activity.model import Activity
 
 
 log = logging.getLogger(__name__)
 
+USERNAME_ALLOCATION_ATTEMPTS = 3
+TAG_REPLACE_JOB_RESULT_TTL = 24 * 60 * 60
+
 
 def dataset_duplicate(context, data_dict):
+    """
+    Duplicates a dataset, its resources and their stored files.
+
+    All changes are made in one database transaction, so a duplicate costs
+    a single commit and search index update, and the created dataset is
+    returned without showing it again.
+    """
+    model = context['model']
+
+    try:
+        with _savepoint(model):
+            duplicate_dataset = _duplicate_dataset(context, data_dict)
+        model.repo.commit()
+    except Exception:
+        model.Session.rollback()
+        raise
+
+    return duplicate_dataset
+
+
+def dataset_duplicate_many(context, data_dict):
+    """
+    Duplicates several datasets, e.g. a country's whole set of projections.
+    Each item of 'datasets' holds the id of a dataset to duplicate and any
+    fields to override in its copy, as for dataset_duplicate.
+
+    Up to batch_size duplications are committed per database transaction,
+    each made within a savepoint so that one failing doesn't undo the
+    others. Should a batch fail to commit, its duplications are reported
+    as failed and later batches are still attempted. Returns the outcome
+    of each duplication in the order given.
+    """
+    model = context['model']
+    datasets = _get_list_of_dicts(data_dict, 'datasets')
+    batch_size = _get_batch_size(data_dict, 'ckanext.spectrum.duplicate_batch_size', 10)
+
+    if not all(dataset.get('id') for dataset in datasets):
+        raise toolkit.ValidationError({'datasets': [toolkit._('Each dataset must have an id')]})
+
+    results = []
+
+    for start in range(0, len(datasets), batch_size):
+        batch_results = [
+            _duplicate_dataset_in_savepoint(context, dataset)
+            for dataset in datasets[start:start + batch_size]
+        ]
+        try:
+            model.repo.commit()
+        except Exception as e:
+            model.Session.rollback()
+            log.error(f"Failed to commit duplicates of batch starting at dataset {datasets[start]['id']} ...")
+            log.exception(e)
+            results += _fail_uncommitted_duplicates(batch_results, e)
+            continue
+        results += batch_results
+
+        # Rolling back a savepoint drops the search index updates pending
+        # for the whole session, so index the batch's duplicates again
+        if not all(result['success'] for result in batch_results):
+            _reindex_datasets([result['dataset']['id'] for result in batch_results if result['success']])
+
+    return results
+
+
+def _fail_uncommitted_duplicates(batch_results, error):
+    # The duplicates are indexed just before the database commit, so may
+    # have been indexed despite the commit failing
+    results = []
+    for result in batch_results:
+        if result['success']:
+            try:
+                search.clear(result['dataset']['id'])
+            except search.SearchIndexError as e:
+                log.exception(e)
+            result = {'id': result['id'], 'success': False, 'error': str(error)}
+        results.append(result)
+    return results
+
+
+def dataset_delete_many(context, data_dict):
+    """
+    Deletes several datasets, e.g. a set of draft projections, in one
+    transaction. Each dataset is deleted as package_delete would, but the
+    resulting activities are all inserted together when the transaction
+    commits. Returns the outcome for each dataset in the order given.
+    """
+    model = context['model']
+    ids = toolkit.aslist(toolkit.get_or_bust(data_dict, 'ids'))
+    results = []
+    deleted = []
+
+    for dataset_id in ids:
+        result = {'id': dataset_id, 'success': False}
+        results.append(result)
+        package = model.Package.get(dataset_id)
+
+        if not package:
+            result['error'] = toolkit._('Dataset not found')
+            continue
+
+        # Auth functions memoize the package in the context, so each dataset needs its own
+        package_context = {**context, 'package': package}
+        try:
+            toolkit.check_access('package_delete', package_context, {'id': package.id})
+        except toolkit.NotAuthorized as e:
+            result['error'] = str(e)
+            continue
+
+        for plugin in plugins.PluginImplementations(plugins.IPackageController):
+            plugin.delete(package)
+            plugin.after_dataset_delete(package_context, {'id': package.id})
+
+        package.delete()
+        result.update({'id': package.id, 'success': True})
+        deleted.append(package)
+
+    if deleted:
+        deleted_ids = [package.id for package in deleted]
+        model.Session.query(model.Member) \
+            .filter(model.Member.table_id.in_(deleted_ids), model.Member.state == 'active') \
+            .update({'state': 'deleted'}, synchronize_session=False)
+        model.Session.query(model.PackageMember) \
+            .filter(model.PackageMember.package_id.in_(deleted_ids)) \
+            .delete(synchronize_session=False)
+        _add_public_dataset_deleted_activities(context, [package for package in deleted if not package.private])
+        model.repo.commit()
+
+    return results
+
+
+def _add_public_dataset_deleted_activities(context, packages):
+    # Private datasets' activities are added by the after_dataset_delete hook
+    if not packages or not plugins.plugin_loaded('activity'):
+        return
+
+    model = context['model']
+    user = model.User.by_name(context['user'])
+    user_id = getattr(user, 'id', "not logged in")
+    activities = [Activity.activity_stream_item(package, "changed", user_id) for package in packages]
+    model.Session.add_all([activity for activity in activities if activity])
+
+
+def _duplicate_dataset(context, data_dict):
+    """
+    Makes a duplicate within the current transaction, leaving the caller
+    to commit it.
+    """
     dataset_id_or_name = toolkit.get_or_bust(data_dict, 'id')
     dataset = toolkit.get_action('package_show')(context, {'id': dataset_id_or_name})
     dataset_id = dataset['id']
@@ -27,10 +197,82 @@ def dataset_duplicate(context, data_dict):
         del resource['id']
         del resource['package_id']
 
-    duplicate_dataset = toolkit.get_action('package_create')(context, dataset)
-    _record_dataset_duplication(dataset_id, duplicate_dataset['id'], context)
+    write_context = {**context, 'defer_commit': True}
+    duplicate_dataset = toolkit.get_action('package_create')(write_context, dataset)
+    duplicate_dataset = _copy_resource_objects(write_context, duplicate_dataset)
+    _record_dataset_duplication(dataset_id, duplicate_dataset['id'], write_context)
+
+    # As package_show would now show, which the caller no longer needs to call
+    duplicate_dataset['relationships_as_subject'] = _get_relationships_as_subject(
+        context['model'], duplicate_dataset['id'], write_context
+    )
+
+    return duplicate_dataset
+
+
+def _duplicate_dataset_in_savepoint(context, data_dict):
+    dataset_id = data_dict['id']
+
+    try:
+        with _savepoint(context['model']):
+            duplicate_dataset = _duplicate_dataset(dict(context), dict(data_dict))
+    except Exception as e:
+        log.error(f"Failed to duplicate dataset {dataset_id} ...")
+        log.exception(e)
+        error = e.error_dict if isinstance(e, toolkit.ValidationError) else str(e)
+        return {'id': dataset_id, 'success': False, 'error': error}
+
+    return {'id': dataset_id, 'success': True, 'dataset': duplicate_dataset}
 
-    return toolkit.get_action('package_show')(context, {'id': duplicate_dataset['id']})
+
+def resource_create_many(context, data_dict):
+    """
+    Creates several resources on one dataset in a single package revision.
+    Attached files are uploaded to Giftless concurrently using one
+    authorization token.
+
+    Resources are given as a list under 'resources'. When posting a
+    multipart form, 'resources' may be a JSON string and the file for the
+    resource at index i sent as 'upload-i'.
+    """
+    model = context['model']
+    package_id = toolkit.get_or_bust(data_dict, 'package_id')
+    resources = _get_resources_to_create(data_dict)
+
+    pkg_dict = toolkit.get_action('package_show')(dict(context, for_update=True), {'id': package_id})
+    toolkit.check_access('resource_create', context, {'package_id': pkg_dict['id']})
+
+    for resource in resources:
+        resource['package_id'] = pkg_dict['id']
+        resource.setdefault('url', '')
+
+    spectrum_upload.handle_giftless_uploads_many(context, pkg_dict['id'], resources)
+
+    for resource in resources:
+        for plugin in plugins.PluginImplementations(plugins.IResourceController):
+            plugin.before_resource_create(context, resource)
+
+    existing_resources = pkg_dict.get('resources', [])
+    pkg_dict['resources'] = existing_resources + resources
+
+    toolkit.get_action('package_update')(
+        {**context, 'defer_commit': True, 'use_cache': False},
+        pkg_dict
+    )
+    model.repo.commit()
+
+    updated_pkg_dict = toolkit.get_action('package_show')(context, {'id': pkg_dict['id']})
+    created_resources = updated_pkg_dict['resources'][len(existing_resources):]
+
+    for resource in created_resources:
+        toolkit.get_action('resource_create_default_resource_views')(
+            {'model': model, 'user': context['user'], 'ignore_auth': True},
+            {'resource': resource, 'package': updated_pkg_dict}
+        )
+        for plugin in plugins.PluginImplementations(plugins.IResourceController):
+            plugin.after_resource_create(context, resource)
+
+    return created_resources
 
 
 @toolkit.chained_action
@@ -66,6 +308,8 @@ def user_create(next_action, context, data_dict):
     if not data_dict.get('password'):
         data_dict['password'] = secrets.token_urlsafe(32)
 
+    email = None
+
     if not data_dict.get('name'):
         if not data_dict.get('email'):
             raise toolkit.ValidationError(toolkit._("Must specify either a name or an email"))
@@ -73,25 +317,216 @@ def user_create(next_action, context, data_dict):
         username = _get_random_username_from_email(email, context['model'])
         data_dict['name'] = username
 
+    # user_create_many checks ids and adds to the organisation for the batch
+    if context.get('bulk_create'):
+        return next_action(context, data_dict)
+
     check_id_is_unique(context, data_dict)
 
-    created_user = next_action(context, data_dict)
+    created_user = _create_user(next_action, context, data_dict, generated_from_email=email)
 
     assign_user_to_default_organisation(context, created_user)
 
     return created_user
 
 
+def user_create_many(context, data_dict):
+    """
+    Creates several users, e.g. when onboarding a partner country.
+
+    All entries are checked before any user is created, with one query for
+    the ids given. Each user is then created within a savepoint, so that one
+    failing doesn't undo the others, and the users created are added to the
+    default organisation in one write. Returns the outcome for each user in
+    the order given.
+    """
+    model = context['model']
+    users = _get_list_of_dicts(data_dict, 'users')
+    toolkit.check_access('user_create', context, {})
+    errors = _check_new_users(context, users)
+    results = []
+    created_users = []
+
+    for user_dict, error in zip(users, errors):
+        result = {'name': user_dict.get('name'), 'email': user_dict.get('email'), 'success': False}
+        results.append(result)
+
+        if error:
+            result['error'] = error
+            continue
+
+        try:
+            with _savepoint(model):
+                created_user = toolkit.get_action('user_create')(
+                    {**context, 'defer_commit': True, 'bulk_create': True},
+                    dict(user_dict)
+                )
+        except Exception as e:
+            log.error(f"Failed to create user {user_dict.get('name')} ...")
+            log.exception(e)
+            result['error'] = e.error_dict if isinstance(e, toolkit.ValidationError) else str(e)
+            continue
+
+        result.update({'success': True, 'user': created_user})
+        created_users.append(created_user)
+
+    _add_users_to_default_organisation(context, created_users)
+    model.repo.commit()
+
+    return results
+
+
+def _check_new_users(context, users):
+    """
+    Returns an error, or None, for each new user. Ids are checked with one
+    query and names are allocated for users given only an email address.
+    """
+    model = context['model']
+    errors = [None] * len(users)
+    ids = [user['id'] for user in users if isinstance(user.get('id'), str)]
+    taken_ids = set()
+
+    if ids:
+        for user_id, user_name in model.Session.query(model.User.id, model.User.name).filter(
+            sa.or_(model.User.id.in_(ids), model.User.name.in_(ids))
+        ):
+            taken_ids.update({user_id, user_name})
+
+    allocated_names = set()
+
+    for index, user in enumerate(users):
+        if 'id' in user:
+            if not isinstance(user['id'], str):
+                errors[index] = {'id': [_('User IDs must be strings')]}
+                continue
+            if user['id'] in taken_ids:
+                errors[index] = {'id': [_('That user ID is not available.')]}
+                continue
+            taken_ids.add(user['id'])
+
+        if not user.get('name'):
+            if not user.get('email'):
+                errors[index] = {'name': [_('Must specify either a name or an email')]}
+                continue
+            user['name'] = _get_random_username_from_email(user['email'], model, reserved=allocated_names)
+
+        if user['name'] in allocated_names:
+            errors[index] = {'name': [_('That login name is not available.')]}
+            continue
+        allocated_names.add(user['name'])
+
+    return errors
+
+
+def _add_users_to_default_organisation(context, created_users):
+    if not created_users:
+        return
+
+    model = context['model']
+    organisation_id = default_organisation.get_id(model)
+
+    if not organisation_id:
+        log.error(f"Failed to add newly created users: {', '.join(u['name'] for u in created_users)} "
+                  f"to org: {default_organisation.name}. User accounts got created successfully.")
+        return
+
+    model.Session.add_all([
+        model.Member(
+            table_name='user',
+            table_id=created_user['id'],
+            group_id=organisation_id,
+            capacity='editor',
+            state='active'
+        )
+        for created_user in created_users
+    ])
+    spectrum_upload.clear_authz_token_cache()
+
+
+def _create_user(next_action, context, data_dict, generated_from_email=None):
+    """
+    Where the user name was generated from an email address, another
+    request may take it first, in which case a new name is allocated and
+    the user created again.
+    """
+    for attempt in range(1, USERNAME_ALLOCATION_ATTEMPTS + 1):
+        try:
+            return next_action(context, dict(data_dict))
+        except (toolkit.ValidationError, sa.exc.IntegrityError) as e:
+            if not generated_from_email or attempt == USERNAME_ALLOCATION_ATTEMPTS or not _is_name_conflict(e):
+                raise
+            log.warning(f"User name {data_dict['name']} was taken while creating the user, allocating another")
+            context['model'].Session.rollback()
+            data_dict['name'] = _get_random_username_from_email(generated_from_email, context['model'])
+
+
+def _is_name_conflict(error):
+    if isinstance(error, toolkit.ValidationError):
+        return 'name' in (error.error_dict or {})
+    return 'user_name_key' in str(error.orig)
+
+
+@toolkit.chained_action
+def user_update(next_action, context, data_dict):
+    result = next_action(context, data_dict)
+    spectrum_authn.substitute_user_cache.invalidate(result['id'])
+    spectrum_upload.clear_authz_token_cache()
+    return result
+
+
+@toolkit.chained_action
+def user_delete(next_action, context, data_dict):
+    result = next_action(context, data_dict)
+    spectrum_authn.substitute_user_cache.invalidate(data_dict.get('id'))
+    spectrum_upload.clear_authz_token_cache()
+    return result
+
+
 def assign_user_to_default_organisation(context, created_user):
-    default_org_name = toolkit.config.get('ckanext.spectrum.default_organization', 'spectrum')
-    org_member_dict = {'id': default_org_name, 'username': created_user['name'], 'role': 'editor'}
+    _add_users_to_default_organisation(context, [created_user])
+    context['model'].repo.commit()
 
-    try:
-        ignore_auth_context = {"user": context["user"], "ignore_auth": True}
-        toolkit.get_action('organization_member_create')(ignore_auth_context, org_member_dict)
-    except toolkit.ValidationError:
-        log.error(f"Failed to add newly created user: {created_user['name']} to org: {default_org_name}. "
-                  f"User account got created successfully.")
+
+class DefaultOrganisation():
+    """
+    Holds the id of the organisation new users are added to, so that it is
+    only looked up by name when configured or after organisations change.
+    """
+
+    def __init__(self, name='spectrum'):
+        self._lock = threading.Lock()
+        self.configure(name)
+
+    def configure(self, name):
+        with self._lock:
+            self.name = name
+            self._id = None
+
+    def get_id(self, model):
+        with self._lock:
+            name, organisation_id = self.name, self._id
+
+        if organisation_id:
+            return organisation_id
+
+        organisation_id = model.Session.query(model.Group.id).filter(
+            model.Group.name == name,
+            model.Group.is_organization.is_(True),
+            model.Group.state == 'active'
+        ).scalar()
+
+        with self._lock:
+            if self.name == name:
+                self._id = organisation_id
+
+        return organisation_id
+
+    def forget(self):
+        with self._lock:
+            self._id = None
+
+
+default_organisation = DefaultOrganisation()
 
 
 def check_id_is_unique(context, data_dict):
@@ -115,6 +550,102 @@ def check_id_is_unique(context, data_dict):
             raise ValidationError(_('That user ID is not available.'))
 
 
+@toolkit.chained_action
+def package_collaborator_create(next_action, context, data_dict):
+    result = next_action(context, data_dict)
+    spectrum_authz.clear_collaborator_cache()
+    spectrum_upload.clear_authz_token_cache()
+    return result
+
+
+@toolkit.chained_action
+def package_collaborator_delete(next_action, context, data_dict):
+    result = next_action(context, data_dict)
+    spectrum_authz.clear_collaborator_cache()
+    spectrum_upload.clear_authz_token_cache()
+    return result
+
+
+@toolkit.chained_action
+def organization_update(next_action, context, data_dict):
+    result = next_action(context, data_dict)
+    default_organisation.forget()
+    return result
+
+
+@toolkit.chained_action
+def organization_delete(next_action, context, data_dict):
+    result = next_action(context, data_dict)
+    default_organisation.forget()
+    return result
+
+
+@toolkit.chained_action
+def organization_purge(next_action, context, data_dict):
+    result = next_action(context, data_dict)
+    default_organisation.forget()
+    return result
+
+
+@toolkit.chained_action
+def organization_member_create(next_action, context, data_dict):
+    result = next_action(context, data_dict)
+    spectrum_upload.clear_authz_token_cache()
+    return result
+
+
+@toolkit.chained_action
+def organization_member_delete(next_action, context, data_dict):
+    result = next_action(context, data_dict)
+    spectrum_upload.clear_authz_token_cache()
+    return result
+
+
+@toolkit.chained_action
+def activity_show(next_action, context, data_dict):
+    activity = _get_activity(context, data_dict)
+    with spectrum_activity.reconstructed(context['model'], [activity]):
+        return next_action(context, data_dict)
+
+
+@toolkit.chained_action
+@toolkit.side_effect_free
+def activity_data_show(next_action, context, data_dict):
+    activity = _get_activity(context, data_dict)
+    with spectrum_activity.reconstructed(context['model'], [activity]):
+        return next_action(context, data_dict)
+
+
+@toolkit.chained_action
+@toolkit.side_effect_free
+def activity_diff(next_action, context, data_dict):
+    activity = _get_activity(context, data_dict)
+    activities = [activity]
+    if activity is not None:
+        activities.append(spectrum_activity.get_previous_activity(context['model'], activity))
+    with spectrum_activity.reconstructed(context['model'], activities):
+        return next_action(context, data_dict)
+
+
+@toolkit.side_effect_free
+def spectrum_stats(context, data_dict):
+    """
+    Reports, to sysadmins, the statistics gathered by the CKAN process
+    serving the request: the requests seen in each route class, the
+    substitute user cache's hits and misses, and the connections reused by
+    the shared Giftless and storage session. Each worker process keeps its
+    own.
+    """
+    if not context.get('ignore_auth') and not authz.is_sysadmin(context.get('user')):
+        raise toolkit.NotAuthorized(toolkit._('Only system administrators can see the statistics'))
+
+    return {
+        'routes': spectrum_authn.route_matcher.stats(),
+        'substitute_user_cache': spectrum_authn.substitute_user_cache.stats(),
+        'lfs_session': spectrum_lfs.session_stats()
+    }
+
+
 def dataset_tag_replace(context, data_dict):
     if 'tags' not in data_dict or not isinstance(data_dict['tags'], dict):
         raise toolkit.ValidationError(toolkit._(
@@ -122,19 +653,149 @@ def dataset_tag_replace(context, data_dict):
             "{'old_tag_name1': 'new_tag_name1', 'old_tag_name2': 'new_tag_name2'}"))
 
     tags = data_dict.pop("tags")
+    batch_size = _get_batch_size(data_dict, 'ckanext.spectrum.tag_replace_batch_size', 100)
+    run_async = toolkit.asbool(data_dict.pop('async', False))
+    direct = toolkit.asbool(data_dict.pop('direct', False))
     package_search_params = _restrict_datasets_to_those_with_tags(data_dict, tags)
 
-    datasets = toolkit.get_action('package_search')(context, package_search_params).get('results', [])
+    if direct:
+        _check_direct_tag_replace_allowed(context, tags)
+
+    if run_async:
+        job = toolkit.enqueue_job(
+            spectrum_jobs.dataset_tag_replace_job,
+            [context['user'], package_search_params, tags, batch_size],
+            {'direct': direct},
+            title=f"dataset_tag_replace by {context['user']}",
+            rq_kwargs={
+                'result_ttl': TAG_REPLACE_JOB_RESULT_TTL,
+                'meta': {'user_id': _get_user_id(context)}
+            }
+        )
+        return {'job_id': job.id}
+
+    return _replace_tags(context, package_search_params, tags, batch_size, direct=direct)
+
+
+def dataset_tag_replace_status(context, data_dict):
+    """
+    Reports the progress of a dataset_tag_replace job enqueued with async,
+    to sysadmins and the user who started it.
+    """
+    job_id = toolkit.get_or_bust(data_dict, 'id')
+    try:
+        job = jobs.job_from_id(job_id)
+    except KeyError:
+        raise toolkit.ObjectNotFound(toolkit._('Job not found'))
+
+    user_id = _get_user_id(context)
+    authorized = context.get('ignore_auth') or authz.is_sysadmin(context.get('user')) or \
+        (user_id and job.meta.get('user_id') == user_id)
+    if not authorized:
+        raise toolkit.NotAuthorized(toolkit._(f"User {context.get('user')} not authorized to see job {job_id}"))
+
+    return {
+        **jobs.dictize_job(job),
+        'status': job.get_status(),
+        'progress': job.meta.get('progress', {'scanned': 0, 'patched': 0, 'failed': 0}),
+        'error': job.meta.get('error'),
+        'result': job.result
+    }
+
+
+def _get_user_id(context):
+    user = context.get('auth_user_obj')
+    if getattr(user, 'name', None) != context.get('user'):
+        user = context['model'].User.by_name(context.get('user'))
+    return getattr(user, 'id', None)
+
+
+def _replace_tags(context, package_search_params, tags, batch_size, progress=None, direct=False):
+    datasets = _search_all_datasets(context, package_search_params)
+
+    if progress:
+        progress.scanned(len(datasets))
+
+    if direct:
+        batches = _replace_tags_directly(context, datasets, tags)
+        if progress and batches:
+            progress.patched(batches[0]['datasets'])
+    else:
+        _check_user_access_to_all_datasets(context, datasets)
+        batches = _update_tags(context, datasets, tags, batch_size, progress=progress)
 
-    _check_user_access_to_all_datasets(context, datasets)
-    _update_tags(context, datasets, tags)
+    return {'datasets_modified': sum(batch['datasets'] for batch in batches), 'batches': batches}
 
-    return {'datasets_modified': len(datasets)}
+
+def _check_direct_tag_replace_allowed(context, tags):
+    if not authz.is_sysadmin(context.get('user')):
+        raise toolkit.NotAuthorized(toolkit._('Only system administrators can replace tags directly'))
+
+    errors = {}
+    for new_tag_name in set(tags.values()):
+        try:
+            tag_length_validator(new_tag_name, context)
+            tag_name_validator(new_tag_name, context)
+        except toolkit.Invalid as e:
+            errors[new_tag_name] = [e.error]
+
+    if errors:
+        raise toolkit.ValidationError({'tags': errors})
+
+
+def _get_batch_size(data_dict, config_option, default):
+    batch_size = data_dict.pop(
+        'batch_size',
+        toolkit.config.get(config_option, default)
+    )
+    try:
+        batch_size = int(batch_size)
+    except (TypeError, ValueError):
+        batch_size = 0
+
+    if batch_size < 1:
+        raise toolkit.ValidationError({'batch_size': [toolkit._('Must be a positive integer')]})
+
+    return batch_size
+
+
+def _search_all_datasets(context, package_search_params):
+    """
+    Walks every page of the package_search results, rather than just the
+    first one, returning the id and tags of each matching dataset.
+    """
+    package_search = toolkit.get_action('package_search')
+    page_size = toolkit.config.get('ckan.search.rows_max', 1000)
+    search_params = {
+        **package_search_params,
+        'fl': ['id', 'tags'],
+        'sort': 'id asc',
+        'rows': page_size
+    }
+
+    datasets = []
+    start = 0
+    while True:
+        page = package_search(context.copy(), {**search_params, 'start': start})
+        results = page.get('results', [])
+        datasets += [
+            {'id': ds['id'], 'tags': [{'name': tag} for tag in ds.get('tags', [])]}
+            for ds in results
+        ]
+        start += len(results)
+        if not results or start >= page.get('count', 0):
+            break
+
+    return datasets
 
 
 def _check_user_access_to_all_datasets(context, datasets):
-    for ds in datasets:
-        toolkit.check_access('package_patch', context, {"id": ds['id']})
+    allowed, denied = spectrum_authz.package_update_bulk(context, [ds['id'] for ds in datasets])
+
+    if denied:
+        raise toolkit.NotAuthorized(toolkit._(
+            f"User {context['user']} not authorized to edit packages {', '.join(denied)}"
+        ))
 
 
 def _restrict_datasets_to_those_with_tags(package_search_params, tags):
@@ -149,12 +810,198 @@ def _restrict_datasets_to_those_with_tags(package_search_params, tags):
     return package_search_params
 
 
-def _update_tags(context, datasets, tags_to_be_replaced):
-    dataset_patch_action = toolkit.get_action('package_patch')
+def _update_tags(context, datasets, tags_to_be_replaced, batch_size, progress=None):
+    """
+    Patches the datasets in batches, committing each batch to the database
+    once rather than once per dataset, and then indexing it with a single
+    search index commit. Each dataset is patched within a savepoint, where
+    the commits CKAN's activity plugin makes for public datasets only flush
+    the session, so public and private datasets share their batch's
+    transaction alike. The direct mode replaces tags in a single
+    transaction.
+
+    If a progress tracker is given, each dataset is counted as patched or
+    failed on its own and the remaining datasets are still attempted.
+    Otherwise the first failure is raised.
+    """
+    model = context['model']
+    batches = []
+
+    for batch_start in range(0, len(datasets), batch_size):
+        batch = datasets[batch_start:batch_start + batch_size]
+        started = time.perf_counter()
+        patched_ids = []
+
+        try:
+            for ds in batch:
+                if not _patch_tags_in_savepoint(context, ds, tags_to_be_replaced, raise_errors=not progress):
+                    progress.failed(1)
+                    continue
+                patched_ids.append(ds['id'])
+            model.repo.commit()
+        except Exception as e:
+            model.Session.rollback()
+            if not progress:
+                raise
+            log.error(f"Failed to commit tag replacements for batch starting at dataset {batch[0]['id']} ...")
+            log.exception(e)
+            progress.failed(len(patched_ids))
+            continue
+
+        # Rolling back a savepoint drops the search index updates pending
+        # for the whole session, so the batch is indexed as a whole
+        _reindex_datasets(patched_ids)
+
+        batches.append({
+            'datasets': len(patched_ids),
+            'seconds': round(time.perf_counter() - started, 3)
+        })
+
+        if progress:
+            progress.patched(len(patched_ids))
+
+    return batches
+
+
+def _patch_tags(context, dataset, tags_to_be_replaced):
+    final_tags = _prepare_final_tag_list(dataset['tags'], tags_to_be_replaced)
+    patch_context = {**context, 'defer_commit': True}
+    patch_context.pop('package', None)
+    toolkit.get_action('package_patch')(patch_context, {'id': dataset['id'], 'tags': final_tags})
+
+
+def _patch_tags_in_savepoint(context, dataset, tags_to_be_replaced, raise_errors=False):
+    try:
+        with _savepoint(context['model']):
+            _patch_tags(context, dataset, tags_to_be_replaced)
+    except Exception as e:
+        if raise_errors:
+            raise
+        log.error(f"Failed to replace tags for dataset {dataset['id']} ...")
+        log.exception(e)
+        return False
+
+    return True
+
 
-    for ds in datasets:
-        final_tags = _prepare_final_tag_list(ds['tags'], tags_to_be_replaced)
-        dataset_patch_action(context, {'id': ds['id'], 'tags': final_tags})
+def _replace_tags_directly(context, datasets, tags_to_be_replaced):
+    """
+    Rewrites the package_tag rows of the datasets with set based SQL rather
+    than a package_patch per dataset. Validation is skipped, so this must
+    only be used by sysadmins. One activity is recorded per affected dataset
+    and only those datasets are reindexed.
+    """
+    model = context['model']
+    session = model.Session
+    package_tags = model.package_tag_table
+    started = time.perf_counter()
+
+    old_tag_ids = _get_free_tag_ids(model, tags_to_be_replaced.keys())
+    new_tag_ids = _get_or_create_free_tag_ids(model, tags_to_be_replaced.values())
+    tag_id_map = {
+        old_tag_ids[old_name]: new_tag_ids[new_name]
+        for old_name, new_name in tags_to_be_replaced.items()
+        if old_name in old_tag_ids and old_name != new_name
+    }
+    dataset_ids = [ds['id'] for ds in datasets]
+
+    if not tag_id_map or not dataset_ids:
+        session.rollback()
+        return []
+
+    matching_rows = sa.and_(
+        package_tags.c.package_id.in_(dataset_ids),
+        package_tags.c.tag_id.in_(list(tag_id_map)),
+        package_tags.c.state == 'active'
+    )
+    affected_ids = [
+        row[0] for row in
+        session.execute(sa.select([package_tags.c.package_id]).where(matching_rows).distinct())
+    ]
+
+    if not affected_ids:
+        session.rollback()
+        return []
+
+    # A single UPDATE applies all replacements at once, so chained renames
+    # such as {'a': 'b', 'b': 'c'} don't cascade.
+    session.execute(
+        package_tags.update()
+        .where(matching_rows)
+        .values(tag_id=sa.case(tag_id_map, value=package_tags.c.tag_id))
+    )
+    _delete_duplicate_package_tags(model, affected_ids)
+    session.execute(
+        model.package_table.update()
+        .where(model.package_table.c.id.in_(affected_ids))
+        .values(metadata_modified=datetime.datetime.utcnow())
+    )
+    session.expire_all()
+
+    if plugins.plugin_loaded('activity'):
+        _record_tag_replace_activities(context, affected_ids)
+
+    model.repo.commit()
+    _reindex_datasets(affected_ids)
+
+    return [{
+        'datasets': len(affected_ids),
+        'seconds': round(time.perf_counter() - started, 3)
+    }]
+
+
+def _get_free_tag_ids(model, tag_names):
+    query = model.Session.query(model.Tag.name, model.Tag.id).filter(
+        model.Tag.name.in_(list(tag_names)),
+        model.Tag.vocabulary_id.is_(None)
+    )
+    return dict(query.all())
+
+
+def _get_or_create_free_tag_ids(model, tag_names):
+    tag_names = set(tag_names)
+    tag_ids = _get_free_tag_ids(model, tag_names)
+    missing_tags = [model.Tag(name=name) for name in tag_names - set(tag_ids)]
+
+    if missing_tags:
+        model.Session.add_all(missing_tags)
+        model.Session.flush()
+        tag_ids.update({tag.name: tag.id for tag in missing_tags})
+
+    return tag_ids
+
+
+def _delete_duplicate_package_tags(model, package_ids):
+    package_tags = model.package_tag_table
+    duplicate = package_tags.alias('duplicate')
+    model.Session.execute(
+        package_tags.delete().where(sa.and_(
+            package_tags.c.package_id.in_(package_ids),
+            package_tags.c.state == 'active',
+            sa.exists().where(sa.and_(
+                duplicate.c.package_id == package_tags.c.package_id,
+                duplicate.c.tag_id == package_tags.c.tag_id,
+                duplicate.c.state == 'active',
+                duplicate.c.id < package_tags.c.id
+            ))
+        ))
+    )
+
+
+def _record_tag_replace_activities(context, package_ids):
+    model = context['model']
+    user = model.User.by_name(context['user'])
+    user_id = getattr(user, 'id', "UnknownUser")
+    packages = model.Session.query(model.Package).filter(model.Package.id.in_(package_ids))
+    compacts_activities = spectrum_activity.compacts_activities()
+
+    for package in packages:
+        activity = Activity.activity_stream_item(package, "changed", user_id)
+        if activity:
+            # As upload.add_activity records private dataset activities
+            if compacts_activities and package.private:
+                spectrum_activity.compact(model, activity)
+            model.Session.add(activity)
 
 
 def _prepare_final_tag_list(original_tags, tags_to_be_replaced):
@@ -166,6 +1013,97 @@ def _prepare_final_tag_list(original_tags, tags_to_be_replaced):
     return final_tags
 
 
+def _get_resources_to_create(data_dict):
+    resources = _get_list_of_dicts(data_dict, 'resources')
+
+    for index, resource in enumerate(resources):
+        if f'upload-{index}' in data_dict:
+            resource['upload'] = data_dict[f'upload-{index}']
+
+    return resources
+
+
+def _get_list_of_dicts(data_dict, key):
+    """
+    Returns a list of dicts given either as a list or, e.g. in a multipart
+    form, as a JSON string.
+    """
+    items = data_dict.get(key)
+
+    if isinstance(items, str):
+        try:
+            items = json.loads(items)
+        except ValueError:
+            items = None
+
+    if not items or not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+        raise toolkit.ValidationError({key: [toolkit._('Must be a non-empty list of objects')]})
+
+    return items
+
+
+@contextlib.contextmanager
+def _savepoint(model):
+    """
+    Runs the block within a savepoint, rolled back if the block raises so
+    that the rest of the transaction is kept.
+
+    CKAN's activity plugin commits when a public dataset or a user is
+    created or updated, as resource_view_create does, which would release
+    the savepoint and index the dataset before the block finishes. Those
+    commits only flush the session while the block runs, leaving the
+    caller to commit.
+    """
+    session = model.Session()
+    savepoint = session.begin_nested()
+    session.commit = session.flush
+    try:
+        yield
+    except Exception:
+        savepoint.rollback()
+        raise
+    else:
+        savepoint.commit()
+    finally:
+        del session.commit
+
+
+def _reindex_datasets(package_ids):
+    """
+    Indexes the datasets with a single search index commit.
+    """
+    if package_ids:
+        search.rebuild(package_ids=package_ids, defer_commit=True, quiet=True)
+        search.commit()
+
+
+def _copy_resource_objects(context, dataset):
+    """
+    Gives a duplicated dataset its own copy of the stored files, so that
+    its resources no longer point at the original dataset's storage.
+    The resources are changed in the session without a package_update, so
+    that they are indexed with the rest of the duplicate.
+    """
+    lfs_prefix = spectrum_upload.copy_resource_objects(context, dataset['id'], dataset.get('resources', []))
+
+    if not lfs_prefix:
+        return dataset
+
+    model = context['model']
+    resources = []
+
+    for resource in dataset['resources']:
+        if resource.get('url_type') == 'upload' and resource.get('sha256') and resource.get('lfs_prefix'):
+            resource = dict(resource, lfs_prefix=lfs_prefix)
+            resource_obj = model.Resource.get(resource['id'])
+            resource_obj.extras = dict(resource_obj.extras or {}, lfs_prefix=lfs_prefix)
+        resources.append(resource)
+
+    model.Session.flush()
+
+    return dict(dataset, resources=resources)
+
+
 def _record_dataset_duplication(dataset_id, new_dataset_id, context):
     # We should probably use activities to record duplication in CKAN 2.10
 
@@ -176,31 +1114,69 @@ def _record_dataset_duplication(dataset_id, new_dataset_id, context):
     }
 
     try:
-        current_activity_id = toolkit.get_action('package_activity_list')(
-            context,
-            {'id': dataset_id}
-        )[0]['id']
+        current_activity_id = _get_latest_activity_id(context['model'], dataset_id)
         relationship['comment'] = f"Duplicated from activity {current_activity_id}"
     except Exception as e:
         log.error(f"Failed to get current activity for package {dataset_id} ...")
         log.exception(e)
 
     try:
-        toolkit.get_action('package_relationship_create')(context, relationship)
+        toolkit.get_action('package_relationship_create')({**context, 'defer_commit': True}, relationship)
     except Exception as e:
         log.error(f"Failed to record duplication of {dataset_id} to {new_dataset_id} ...")
         log.exception(e)
 
+    if not context.get('defer_commit'):
+        context['model'].repo.commit()
+
+
+def _get_relationships_as_subject(model, dataset_id, context):
+    relationships = model.Session.query(model.PackageRelationship) \
+        .filter(model.PackageRelationship.subject_package_id == dataset_id)
+    return [dictization.table_dictize(relationship, context) for relationship in relationships]
+
+
+def _get_latest_activity_id(model, dataset_id):
+    """
+    Looks up the id of a dataset's most recent activity with one query,
+    rather than dictizing its activity list.
+    """
+    if not plugins.plugin_loaded('activity'):
+        raise RuntimeError("The activity plugin is not loaded")
+
+    activity = model.Session.query(Activity.id) \
+        .filter(Activity.object_id == dataset_id) \
+        .order_by(Activity.timestamp.desc()) \
+        .first()
+
+    if not activity:
+        raise toolkit.ObjectNotFound(f"No activity found for package {dataset_id}")
+
+    return activity.id
+
 
-def _get_random_username_from_email(email, model):
+def _get_activity(context, data_dict):
     """
-    This function is copied from a CKAN core private function:
+    Loads the activity into the session, where CKAN's activity actions find
+    it, so that a compacted activity can be reconstructed beforehand.
+    """
+    activity_id = data_dict.get('id')
+    if not activity_id:
+        return None
+    return context['model'].Session.query(Activity).get(activity_id)
+
+
+def _get_random_username_from_email(email, model, reserved=()):
+    """
+    This function is adapted from a CKAN core private function:
         ckan.logic.action.create._get_random_username_from_email
     Github permalink:
         https://github.com/ckan/ckan/blob/0a596b8394dbf9582902853ad91450d2c0d7959b/ckan/logic/action/create.py#L1102-L1116
 
-    The function has been deployed and used across a plethora of CKAN
-    instances, which is why we are adopting it here.
+    Rather than trying random numbers one query at a time, all the names
+    and ids of the form <localpart>-<number> are fetched with one query and
+    the lowest free number, that isn't also reserved, is used. _create_user
+    tries again should another request take the name first.
 
     WARNING: This logic reveals part of the user's email address
     as their username.  Fjelltopp recommends overriding this logic
@@ -209,15 +1185,20 @@ def _get_random_username_from_email(email, model):
 
     localpart = email.split('@')[0]
     cleaned_localpart = re.sub(r'[^\w]', '-', localpart).lower()
+    prefix = cleaned_localpart + '-'
+    like_pattern = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
 
-    # if we can't create a unique user name within this many attempts
-    # then something else is probably wrong and we should give up
-    max_name_creation_attempts = 100
+    taken = model.Session.query(model.User.name, model.User.id).filter(
+        sa.or_(
+            model.User.name.like(like_pattern, escape='\\'),
+            model.User.id.like(like_pattern, escape='\\')
+        )
+    )
+    taken_numbers = {
+        int(value[len(prefix):]) for value in itertools.chain(itertools.chain.from_iterable(taken), reserved)
+        if value.startswith(prefix) and value[len(prefix):].isdigit()
+    }
 
-    for i in range(max_name_creation_attempts):
-        random_number = random.SystemRandom().random() * 10000
-        name = '%s-%d' % (cleaned_localpart, random_number)
-        if not model.User.get(name):
-            return name
+    number = next(number for number in itertools.count(1) if number not in taken_numbers)
 
-    return cleaned_localpart
+    return f'{prefix}{number}'
@@ -0,0 +1,222 @@
+import contextlib
+import json
+import logging
+
+from sqlalchemy.orm.attributes import set_committed_value
+
+import ckan.plugins.toolkit as toolkit
+from ckanext.activity.model import Activity
+
+
+log = logging.getLogger(__name__)
+
+COMPACT_KEY = 'spectrum_compact'
+
+# Enough of the package for the activity stream templates and dataset links
+PROJECTION_FIELDS = (
+    'id', 'name', 'title', 'type', 'state', 'private', 'owner_org',
+    'creator_user_id', 'metadata_modified', 'num_resources'
+)
+# CKAN's resource_history view reads the stored package directly, so keep
+# enough of each resource for it to find and show the resource
+RESOURCE_PROJECTION_FIELDS = (
+    'id', 'package_id', 'name', 'url', 'url_type', 'format', 'size', 'last_modified'
+)
+
+
+def compacts_activities():
+    return toolkit.asbool(toolkit.config.get('ckanext.spectrum.compact_activities', False))
+
+
+def _snapshot_interval():
+    return max(toolkit.asint(toolkit.config.get('ckanext.spectrum.activity_snapshot_interval', 10)), 1)
+
+
+def compact(model, activity):
+    """
+    Replaces the package snapshot held by a new activity with the changes
+    since the previous activity of the same dataset, keeping a small
+    projection of the package for the activity stream. Every
+    activity_snapshot_interval activities, or when the changes are no
+    smaller than the package, the full snapshot is kept instead, so
+    reconstructing a package never reads more than that many activities.
+    """
+    package = activity.data.get('package')
+    interval = _snapshot_interval()
+    if not package or interval == 1:
+        return activity
+
+    previous = _get_activities_before(model, activity.object_id, activity.timestamp, interval)
+    if not previous:
+        return activity
+    depth = ((previous[0].data or {}).get(COMPACT_KEY) or {}).get('depth', 0) + 1
+    if depth >= interval:
+        return activity
+    previous_package = _reconstruct_package(model, previous[0], previous[1:])
+    if previous_package is None:
+        return activity
+
+    changes = diff(previous_package, package)
+    if len(json.dumps(changes)) >= len(json.dumps(package)):
+        return activity
+
+    activity.data = dict(
+        activity.data,
+        package=project(package),
+        **{COMPACT_KEY: {'base_activity_id': previous[0].id, 'depth': depth, 'changes': changes}}
+    )
+    return activity
+
+
+def project(package):
+    projection = _project(package, PROJECTION_FIELDS)
+    projection['resources'] = [
+        _project(resource, RESOURCE_PROJECTION_FIELDS) for resource in package.get('resources', [])
+    ]
+    return projection
+
+
+def _project(obj, fields):
+    return {key: obj[key] for key in fields if key in obj}
+
+
+def is_compact(activity):
+    return bool(activity.data and activity.data.get(COMPACT_KEY))
+
+
+def get_data(model, activity):
+    """
+    Returns the data of an activity, with the full package restored if the
+    activity was compacted.
+    """
+    if not is_compact(activity):
+        return activity.data
+    depth = activity.data[COMPACT_KEY]['depth']
+    previous = _get_activities_before(model, activity.object_id, activity.timestamp, depth)
+    package = _reconstruct_package(model, activity, previous)
+    data = {key: value for key, value in activity.data.items() if key != COMPACT_KEY}
+    if package is not None:
+        data['package'] = package
+    return data
+
+
+@contextlib.contextmanager
+def reconstructed(model, activities):
+    """
+    Makes the given activities hold their full data while the block runs,
+    so that CKAN's activity actions read the restored packages. The values
+    are set as if loaded from the database, so they are never written back,
+    and are reloaded once the block exits.
+    """
+    activities = [activity for activity in activities if activity is not None and is_compact(activity)]
+    restored = [(activity, get_data(model, activity)) for activity in activities]
+    for activity, data in restored:
+        set_committed_value(activity, 'data', data)
+    try:
+        yield
+    finally:
+        for activity in activities:
+            model.Session.expire(activity, ['data'])
+
+
+def get_previous_activity(model, activity):
+    previous = _get_activities_before(model, activity.object_id, activity.timestamp, 1)
+    return previous[0] if previous else None
+
+
+def _get_activities_before(model, object_id, timestamp, limit):
+    return (
+        model.Session.query(Activity)
+        .filter(Activity.object_id == object_id)
+        .filter(Activity.timestamp < timestamp)
+        .order_by(Activity.timestamp.desc())
+        .limit(limit)
+        .all()
+    )
+
+
+def _reconstruct_package(model, activity, previous):
+    """
+    Restores the package of an activity by applying the changes recorded
+    since the nearest full snapshot, given the activities preceding it
+    newest first.
+    """
+    by_id = {a.id: a for a in previous}
+    chain = [activity]
+    while is_compact(chain[-1]):
+        base_id = chain[-1].data[COMPACT_KEY]['base_activity_id']
+        base = by_id.get(base_id) or model.Session.query(Activity).get(base_id)
+        if base is None:
+            log.warning(f"Cannot reconstruct activity {activity.id}, activity {base_id} is missing")
+            return None
+        chain.append(base)
+
+    package = (chain.pop().data or {}).get('package')
+    while chain:
+        package = patch(package, chain.pop().data[COMPACT_KEY]['changes'])
+    return package
+
+
+def diff(old, new):
+    """
+    Returns the changes turning dict old into dict new. Nested dicts, and
+    lists of dicts identified by their ids like resources, are diffed
+    recursively, any other changed value is stored whole.
+    """
+    changes = {'set': {}, 'unset': [key for key in old if key not in new], 'patch': {}}
+    for key, value in new.items():
+        if key not in old:
+            changes['set'][key] = value
+        elif old[key] == value:
+            continue
+        elif isinstance(value, dict) and isinstance(old[key], dict):
+            changes['patch'][key] = diff(old[key], value)
+        elif _is_id_list(value) and _is_id_list(old[key]):
+            changes['patch'][key] = _diff_id_list(old[key], value)
+        else:
+            changes['set'][key] = value
+    return {key: value for key, value in changes.items() if value}
+
+
+def patch(old, changes):
+    """
+    Applies changes returned by diff to a copy of old.
+    """
+    if 'ids' in changes:
+        return _patch_id_list(old, changes)
+    new = {key: value for key, value in old.items() if key not in changes.get('unset', [])}
+    new.update(changes.get('set', {}))
+    for key, value_changes in changes.get('patch', {}).items():
+        new[key] = patch(old[key], value_changes)
+    return new
+
+
+def _is_id_list(value):
+    if not isinstance(value, list) or not all(isinstance(item, dict) and 'id' in item for item in value):
+        return False
+    return len({item['id'] for item in value}) == len(value)
+
+
+def _diff_id_list(old, new):
+    old_items = {item['id']: item for item in old}
+    changes = {'ids': [item['id'] for item in new], 'set': {}, 'patch': {}}
+    for item in new:
+        old_item = old_items.get(item['id'])
+        if old_item is None:
+            changes['set'][item['id']] = item
+        elif old_item != item:
+            changes['patch'][item['id']] = diff(old_item, item)
+    return changes
+
+
+def _patch_id_list(old, changes):
+    old_items = {item['id']: item for item in old}
+    new = []
+    for item_id in changes['ids']:
+        if item_id in changes['set']:
+            new.append(changes['set'][item_id])
+        elif item_id in changes['patch']:
+            new.append(patch(old_items[item_id], changes['patch'][item_id]))
+        else:
+            new.append(old_items[item_id])
+    return new
@@ -1,9 +1,19 @@
+import copy
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import sqlalchemy as sa
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+
 import ckan.model as model
 from flask import current_app
 
 
 def substitute_user(substitute_user_id):
-    substitute_user_obj = model.User.get(substitute_user_id)
+    substitute_user_obj = _get_user(substitute_user_id)
 
     if not substitute_user_obj:
         return {
@@ -19,3 +29,157 @@ def substitute_user(substitute_user_id):
     # https://github.com/ckan/ckan/issues/7581
     current_app.login_manager._update_request_context_with_user(substitute_user_obj)
 
+
+class RouteMatcher():
+    """
+    Decides from the request path alone whether a request must be made by a
+    sysadmin, using precompiled patterns, and counts the requests seen in
+    each route class: "sysadmin_only", "exempt" and "other". The counts are
+    kept without a lock, so concurrent requests may occasionally go
+    uncounted.
+    """
+
+    def __init__(self, sysadmin_only_patterns=(r'^/api/', r'/download/'), exempt_patterns=()):
+        self.counts = {'sysadmin_only': 0, 'exempt': 0, 'other': 0}
+        self.configure(sysadmin_only_patterns, exempt_patterns)
+
+    def configure(self, sysadmin_only_patterns, exempt_patterns):
+        self._sysadmin_only = _compile_patterns(sysadmin_only_patterns)
+        self._exempt = _compile_patterns(exempt_patterns)
+
+    def requires_sysadmin(self, path):
+        if not self._sysadmin_only or not self._sysadmin_only.search(path):
+            route_class = 'other'
+        elif self._exempt and self._exempt.search(path):
+            route_class = 'exempt'
+        else:
+            route_class = 'sysadmin_only'
+
+        self.counts[route_class] += 1
+
+        return route_class == 'sysadmin_only'
+
+    def stats(self):
+        return dict(self.counts)
+
+
+def _compile_patterns(patterns):
+    if not patterns:
+        return None
+    return re.compile('|'.join(f'(?:{pattern})' for pattern in patterns))
+
+
+route_matcher = RouteMatcher()
+
+
+class SubstituteUserCache():
+    """
+    Bounded, thread safe LRU cache of the users identified by the
+    CKAN-Substitute-User header, keyed by both user name and user id.
+
+    Only the user's column values are stored, never the ORM object itself,
+    so that nothing is shared between the sessions of different requests.
+    """
+
+    def __init__(self, max_size=100, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._keys = {}
+        self._lock = threading.Lock()
+
+    def configure(self, max_size, ttl):
+        with self._lock:
+            self.max_size = max_size
+            self.ttl = ttl
+            self._entries.clear()
+            self._keys.clear()
+
+    def get(self, name_or_id):
+        with self._lock:
+            user_id = self._keys.get(name_or_id)
+            entry = self._entries.get(user_id)
+
+            if entry and entry['expires'] > time.monotonic():
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return copy.deepcopy(entry['values'])
+
+            self._remove(user_id)
+            self.misses += 1
+            return None
+
+    def set(self, name_or_id, values):
+        with self._lock:
+            if self.max_size < 1:
+                return
+
+            user_id = values['id']
+            self._remove(user_id)
+
+            keys = {name_or_id, user_id, values['name']}
+            self._entries[user_id] = {
+                'expires': time.monotonic() + self.ttl,
+                'keys': keys,
+                'values': copy.deepcopy(values)
+            }
+            for key in keys:
+                self._keys[key] = user_id
+
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, name_or_id):
+        with self._lock:
+            self._remove(self._keys.get(name_or_id, name_or_id))
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+    def _remove(self, user_id):
+        entry = self._entries.pop(user_id, None)
+
+        if entry:
+            for key in entry['keys']:
+                if self._keys.get(key) == user_id:
+                    del self._keys[key]
+
+
+substitute_user_cache = SubstituteUserCache()
+
+
+def _get_user(name_or_id):
+    values = substitute_user_cache.get(name_or_id)
+
+    if values is not None:
+        return _user_from_values(values)
+
+    user = model.User.get(name_or_id)
+
+    if user:
+        substitute_user_cache.set(name_or_id, _user_to_values(user))
+
+    return user
+
+
+def _user_to_values(user):
+    return {
+        attr.key: getattr(user, attr.key)
+        for attr in sa.inspect(model.User).column_attrs
+    }
+
+
+def _user_from_values(values):
+    """
+    Rebuilds a cached user and attaches it to the current session without
+    querying the database.
+    """
+    user = sa.inspect(model.User).class_manager.new_instance()
+    for key, value in values.items():
+        set_committed_value(user, key, value)
+    make_transient_to_detached(user)
+
+    return model.Session.merge(user, load=False)
@@ -1,15 +1,91 @@
 import ckan.logic as logic
 import ckan.model as model
+import ckan.plugins.toolkit as toolkit
 from ckan.common import c, request, is_flask_request
+from ckanext.spectrum.request_cache import get_request_cache
+
+
+# Solr fields returned by get_datasets_from_ids, and their dataset dict keys
+DATASET_SUMMARY_FIELDS = {
+    'id': 'id',
+    'name': 'name',
+    'title': 'title',
+    'dataset_type': 'type',
+    'state': 'state',
+    'organization': 'organization',
+    'capacity': 'private',
+    'metadata_modified': 'metadata_modified'
+}
 
 
 def get_dataset_from_id(id):
-    context = {
-        'model': model, 'ignore_auth': True,
-        'validate': False, 'use_cache': False
-    }
-    package_show_action = logic.get_action('package_show')
-    return package_show_action(context, {'id': id})
+    """
+    Returns the full dataset, memoized for the rest of the request as
+    templates often show the same dataset several times.
+    """
+    cache = get_request_cache('spectrum_datasets')
+
+    if id not in cache:
+        context = {
+            'model': model, 'ignore_auth': True,
+            'validate': False, 'use_cache': False
+        }
+        package_show_action = logic.get_action('package_show')
+        cache[id] = package_show_action(context, {'id': id})
+
+    return cache[id]
+
+
+def get_datasets_from_ids(ids):
+    """
+    Returns a summary of each of the datasets, given by id or name, e.g.
+    for listing related datasets, with the id, name, title, type, state,
+    organization name, privacy and modification date. The datasets not yet
+    memoized in the request are looked up with one search index query
+    rather than a package_show each. Datasets that cannot be found are
+    left out.
+    """
+    cache = get_request_cache('spectrum_dataset_summaries')
+    missing = list(dict.fromkeys(dataset_id for dataset_id in ids if dataset_id not in cache))
+
+    if missing:
+        for summary in _search_dataset_summaries(missing):
+            cache[summary['id']] = cache[summary['name']] = summary
+
+    return [cache[dataset_id] for dataset_id in ids if dataset_id in cache]
+
+
+def _search_dataset_summaries(ids):
+    context = {'model': model, 'ignore_auth': True}
+    package_search_action = logic.get_action('package_search')
+    page_size = toolkit.asint(toolkit.config.get('ckan.search.rows_max', 1000))
+    summaries = []
+
+    for start in range(0, len(ids), page_size):
+        page_ids = ' OR '.join(_solr_phrase(dataset_id) for dataset_id in ids[start:start + page_size])
+        result = package_search_action(context.copy(), {
+            'fq': f'+(id:({page_ids}) OR name:({page_ids}))',
+            'fl': list(DATASET_SUMMARY_FIELDS),
+            'rows': page_size,
+            'include_private': True,
+            'include_drafts': True,
+            'include_deleted': True
+        })
+        summaries += [_dataset_summary(dataset) for dataset in result['results']]
+
+    return summaries
+
+
+def _solr_phrase(value):
+    # Ids come from templates and must not break out of the quoted phrase
+    escaped = str(value).replace('\\', '\\\\').replace('"', '\\"')
+    return f'"{escaped}"'
+
+
+def _dataset_summary(dataset):
+    summary = {key: dataset.get(field) for field, key in DATASET_SUMMARY_FIELDS.items()}
+    summary['private'] = summary['private'] == 'private'
+    return summary
 
 
 def get_facet_items_dict(
@@ -34,18 +110,14 @@ def get_facet_items_dict(
         return []
 
     facets = []
+    active_filters = _get_active_facet_filters()
 
     for facet_item in search_facets.get(facet)['items']:
 
         if not len(facet_item['name'].strip()):
             continue
 
-        if is_flask_request():
-            params_items = request.params.items(multi=True)
-        else:
-            params_items = request.params.items()
-
-        if not (facet, facet_item['name']) in params_items:
+        if not (facet, facet_item['name']) in active_filters:
             facets.append(dict(active=False, **facet_item))
         elif not exclude_active:
             facets.append(dict(active=True, **facet_item))
@@ -65,6 +137,23 @@ def get_facet_items_dict(
     return facets
 
 
+def _get_active_facet_filters():
+    """
+    Returns the (facet, value) pairs of the request parameters as a set,
+    built once per request and shared by all the facets.
+    """
+    cache = get_request_cache('spectrum_facet_filters')
+
+    if 'active' not in cache:
+        if is_flask_request():
+            params_items = request.params.items(multi=True)
+        else:
+            params_items = request.params.items()
+        cache['active'] = set(params_items)
+
+    return cache['active']
+
+
 def _facet_sort_function(facet_name, facet_items):
 
     if facet_name == 'year':
@@ -0,0 +1,72 @@
+import logging
+
+import rq
+
+import ckan.model as model
+import ckanext.spectrum.actions as spectrum_actions
+
+
+log = logging.getLogger(__name__)
+
+
+def dataset_tag_replace_job(user_name, package_search_params, tags, batch_size, direct=False):
+    """
+    Background job running dataset_tag_replace on behalf of the requesting
+    user, recording its progress in the job's meta data.
+    """
+    context = {
+        'model': model,
+        'session': model.Session,
+        'user': user_name,
+        'auth_user_obj': model.User.by_name(user_name)
+    }
+    progress = JobProgress(rq.get_current_job())
+
+    try:
+        return spectrum_actions._replace_tags(
+            context,
+            package_search_params,
+            tags,
+            batch_size,
+            progress=progress,
+            direct=direct
+        )
+    except Exception as e:
+        log.error(f"Tag replacement job for user {user_name} failed ...")
+        log.exception(e)
+        progress.error(str(e))
+        raise
+
+
+class JobProgress():
+    """
+    Counts the datasets scanned, patched and failed by a job, saving the
+    counts to the job's meta data so they can be polled while it runs.
+    """
+
+    def __init__(self, job=None):
+        self.job = job
+        self.counts = {'scanned': 0, 'patched': 0, 'failed': 0}
+        self._save()
+
+    def scanned(self, count):
+        self.counts['scanned'] += count
+        self._save()
+
+    def patched(self, count):
+        self.counts['patched'] += count
+        self._save()
+
+    def failed(self, count):
+        self.counts['failed'] += count
+        self._save()
+
+    def error(self, message):
+        if self.job:
+            self.job.meta['error'] = message
+            self.job.save_meta()
+
+    def _save(self):
+        if self.job:
+            self.job.meta['progress'] = self.counts
+            self.job.save_meta()
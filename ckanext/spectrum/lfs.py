@@ -0,0 +1,458 @@
+import base64
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from giftless_client import LfsClient
+from giftless_client.exc import LfsError
+
+
+log = logging.getLogger(__name__)
+
+CHUNK_SIZE = 4 * 1024 * 1024
+MULTIPART_THRESHOLD = 100 * 1024 * 1024
+PART_ATTEMPTS = 3
+
+_session = None
+_session_lock = threading.Lock()
+_session_settings = {'pool_size': 10, 'timeout': (10, 300)}
+
+
+def configure_session(pool_size, timeout):
+    """
+    Sets the connection pool size and the (connect, read) timeouts of the
+    shared HTTP session, replacing any session already created.
+    """
+    global _session
+    with _session_lock:
+        _session_settings.update({'pool_size': pool_size, 'timeout': timeout})
+        if _session:
+            _session.close()
+        _session = None
+
+
+def get_session():
+    """
+    Returns the process wide HTTP session used for all Giftless and storage
+    requests, so connections are kept alive and reused between uploads.
+    The underlying urllib3 connection pools are thread safe.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            adapter = HTTPAdapter(
+                pool_connections=_session_settings['pool_size'],
+                pool_maxsize=_session_settings['pool_size'],
+                pool_block=True
+            )
+            _session = requests.Session()
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+        return _session
+
+
+def session_stats():
+    """
+    Counts the requests sent and the connections opened by the shared
+    session; every request beyond the connections opened reused one.
+    """
+    stats = {'requests': 0, 'connections': 0}
+
+    with _session_lock:
+        adapters = set(_session.adapters.values()) if _session else set()
+
+    for adapter in adapters:
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool:
+                stats['requests'] += pool.num_requests
+                stats['connections'] += pool.num_connections
+
+    stats['reused'] = max(stats['requests'] - stats['connections'], 0)
+    return stats
+
+
+class PooledLfsClient(LfsClient):
+    """
+    LfsClient sending its requests through the shared, keep-alive HTTP
+    session with timeouts, rather than a new connection per request.
+    """
+
+    def __init__(self, lfs_server_url, auth_token=None, transfer_adapters=('basic',)):
+        super().__init__(lfs_server_url, auth_token=auth_token, transfer_adapters=transfer_adapters)
+        self.session = get_session()
+        self.timeout = _session_settings['timeout']
+
+    def batch(self, prefix, operation, objects, ref=None, transfers=None):
+        payload = {
+            'transfers': list(transfers or self._transfer_adapters),
+            'operation': operation,
+            'objects': objects
+        }
+        if ref:
+            payload['ref'] = ref
+
+        headers = {'Content-type': self.LFS_MIME_TYPE, 'Accept': self.LFS_MIME_TYPE}
+        if self._auth_token:
+            headers['Authorization'] = f'Bearer {self._auth_token}'
+
+        response = self.session.post(
+            self._url_for(prefix, 'objects', 'batch'),
+            json=payload,
+            headers=headers,
+            timeout=self.timeout
+        )
+        if response.status_code != 200:
+            raise LfsError(
+                f"Unexpected response from LFS server: {response.status_code}",
+                status_code=response.status_code
+            )
+        return response.json()
+
+
+def upload(lfs_client, file_obj, organization, repo,
+           chunk_size=CHUNK_SIZE, multipart_threshold=MULTIPART_THRESHOLD, object_attrs=None):
+    """
+    Uploads a file to Giftless, reading it in fixed size chunks so memory
+    use stays bounded however large the file is.
+
+    The LFS batch API needs the sha256 before the transfer starts, so the
+    file is hashed first, unless object_attrs are given, and then streamed
+    to storage. Objects the server already holds are not sent again; the
+    returned "transferred" flag says whether any bytes were uploaded.
+    Files of at least multipart_threshold bytes are sent in parts when the
+    server supports it, retrying individual parts that fail.
+    """
+    if object_attrs is None:
+        object_attrs = get_object_attributes(file_obj, chunk_size)
+
+    transfers = ['basic']
+    if object_attrs['size'] >= multipart_threshold:
+        transfers = ['multipart-basic', 'basic']
+
+    response = lfs_client.batch(
+        f'{organization}/{repo}',
+        'upload',
+        [dict(object_attrs)],
+        transfers=transfers
+    )
+    upload_spec = response['objects'][0]
+
+    if 'error' in upload_spec:
+        raise LfsError(
+            f"LFS server refused upload: {upload_spec['error'].get('message')}",
+            status_code=upload_spec['error'].get('code')
+        )
+
+    if response.get('transfer') == 'multipart-basic':
+        transferred = _multipart_upload(lfs_client, file_obj, upload_spec, chunk_size)
+    else:
+        transferred = _basic_upload(lfs_client, file_obj, upload_spec, chunk_size)
+
+    return dict(object_attrs, transferred=transferred)
+
+
+def copy(source_client, target_client, source_prefix, target_prefix, objects,
+         max_workers=4, server_side=True, chunk_size=CHUNK_SIZE):
+    """
+    Copies objects, given as dicts of oid and size, from one repository to
+    another and returns the number of objects that had to be transferred.
+
+    One batch request finds the objects the target is missing and one more
+    gets their download actions from the source. Each object is then
+    copied concurrently, by the storage itself where server_side is set
+    and the target is Azure Blob Storage (using Put Blob From URL) so no
+    bytes pass through CKAN. Otherwise, or when the storage refuses, the
+    object is streamed from source to target instead.
+    """
+    objects = list({obj['oid']: {'oid': obj['oid'], 'size': int(obj['size'])} for obj in objects}.values())
+
+    if not objects:
+        return 0
+
+    upload_specs = [
+        spec for spec in _batch_specs(target_client, target_prefix, 'upload', objects)
+        if spec.get('actions', {}).get('upload')
+    ]
+
+    if not upload_specs:
+        log.debug(f"All {len(objects)} objects already exist in {target_prefix}")
+        return 0
+
+    download_specs = {
+        spec['oid']: spec for spec in _batch_specs(
+            source_client,
+            source_prefix,
+            'download',
+            [{'oid': spec['oid'], 'size': spec['size']} for spec in upload_specs]
+        )
+    }
+
+    with ThreadPoolExecutor(max_workers=max(min(max_workers, len(upload_specs)), 1)) as executor:
+        copies = [
+            executor.submit(
+                _copy_object, target_client, upload_spec, download_specs[upload_spec['oid']], server_side, chunk_size
+            )
+            for upload_spec in upload_specs
+        ]
+
+    for copied in copies:
+        copied.result()
+
+    return len(upload_specs)
+
+
+def get_object_attributes(file_obj, chunk_size=CHUNK_SIZE):
+    digest = hashlib.sha256()
+    size = 0
+    file_obj.seek(0)
+
+    try:
+        for chunk in iter(lambda: file_obj.read(chunk_size), b''):
+            digest.update(chunk)
+            size += len(chunk)
+    finally:
+        file_obj.seek(0)
+
+    return {'oid': digest.hexdigest(), 'size': size}
+
+
+class FileSection():
+    """
+    Read only, file like view of size bytes of file_obj starting at pos,
+    so that requests can stream it with a known Content-Length.
+    """
+
+    def __init__(self, file_obj, pos, size, chunk_size=CHUNK_SIZE):
+        self.file_obj = file_obj
+        self.pos = pos
+        self.size = size
+        self.chunk_size = chunk_size
+        self.seek(0)
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return iter(lambda: self.read(self.chunk_size), b'')
+
+    def seek(self, offset, whence=0):
+        self._remaining = self.size - offset
+        self.file_obj.seek(self.pos + offset)
+
+    def tell(self):
+        return self.size - self._remaining
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self.file_obj.read(size)
+        self._remaining -= len(data)
+        return data
+
+
+class StreamedObject():
+    """
+    Read only, file like view of a streamed download response, reporting
+    the object's size so requests can upload it with a Content-Length.
+    """
+
+    def __init__(self, response, size, chunk_size=CHUNK_SIZE):
+        self.response = response
+        self.size = size
+        self.chunk_size = chunk_size
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return self.response.iter_content(self.chunk_size)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = None
+        return self.response.raw.read(size)
+
+
+def _batch_specs(lfs_client, prefix, operation, objects):
+    response = lfs_client.batch(prefix, operation, objects)
+
+    for spec in response['objects']:
+        if 'error' in spec:
+            raise LfsError(
+                f"LFS server refused {operation} of {spec['oid']}: {spec['error'].get('message')}",
+                status_code=spec['error'].get('code')
+            )
+
+    return response['objects']
+
+
+def _copy_object(lfs_client, upload_spec, download_spec, server_side, chunk_size):
+    upload_action = upload_spec['actions']['upload']
+    download_action = download_spec['actions']['download']
+
+    # A signed URL is all Azure needs to read the source itself. Other
+    # storage may accept the empty request without copying anything
+    if server_side and _is_azure_blob_action(upload_action) and not download_action.get('header'):
+        try:
+            _server_side_copy(lfs_client, upload_action, download_action)
+            _verify(lfs_client, upload_spec['actions'], upload_spec)
+            return
+        except (requests.ConnectionError, requests.Timeout, LfsError) as e:
+            log.warning(f"Server side copy of {upload_spec['oid']} failed, streaming it instead: {e}")
+
+    _streamed_copy(lfs_client, upload_action, download_action, upload_spec['size'], chunk_size)
+    _verify(lfs_client, upload_spec['actions'], upload_spec)
+
+
+def _is_azure_blob_action(action):
+    hostname = urlparse(action.get('href', '')).hostname or ''
+    headers = {key.lower() for key in (action.get('header') or {})}
+    return hostname.endswith('.blob.core.windows.net') or 'x-ms-blob-type' in headers
+
+
+def _server_side_copy(lfs_client, upload_action, download_action):
+    headers = dict(upload_action.get('header') or {})
+    headers.update({
+        'x-ms-copy-source': download_action['href'],
+        'x-ms-blob-type': 'BlockBlob',
+        'Content-Length': '0'
+    })
+    response = lfs_client.session.put(
+        upload_action['href'],
+        headers=headers,
+        timeout=lfs_client.timeout
+    )
+    _raise_for_status(response, 'server side copy')
+
+
+def _streamed_copy(lfs_client, upload_action, download_action, size, chunk_size):
+    with lfs_client.session.get(
+        download_action['href'],
+        headers=download_action.get('header', {}),
+        stream=True,
+        timeout=lfs_client.timeout
+    ) as download:
+        _raise_for_status(download, 'download')
+        response = lfs_client.session.put(
+            upload_action['href'],
+            headers=upload_action.get('header', {}),
+            data=StreamedObject(download, size, chunk_size),
+            timeout=lfs_client.timeout
+        )
+        _raise_for_status(response, 'upload')
+
+
+def _basic_upload(lfs_client, file_obj, upload_spec, chunk_size):
+    actions = upload_spec.get('actions', {})
+    upload_action = actions.get('upload')
+
+    if not upload_action:
+        log.debug(f"Object {upload_spec['oid']} already exists in storage")
+        return False
+
+    response = lfs_client.session.put(
+        upload_action['href'],
+        headers=upload_action.get('header', {}),
+        data=FileSection(file_obj, 0, upload_spec['size'], chunk_size),
+        timeout=lfs_client.timeout
+    )
+    _raise_for_status(response, 'upload')
+    _verify(lfs_client, actions, upload_spec)
+    return True
+
+
+def _multipart_upload(lfs_client, file_obj, upload_spec, chunk_size):
+    actions = upload_spec.get('actions', {})
+
+    if not actions:
+        log.debug(f"Object {upload_spec['oid']} already exists in storage")
+        return False
+
+    if actions.get('init'):
+        _send_action(lfs_client, actions['init'], 'init')
+
+    parts = actions.get('parts', [])
+    for number, part in enumerate(parts, start=1):
+        log.debug(f"Uploading part {number}/{len(parts)} of {upload_spec['oid']}")
+        _upload_part(lfs_client, file_obj, part, upload_spec['size'], chunk_size)
+
+    if actions.get('commit'):
+        _send_action(lfs_client, actions['commit'], 'commit')
+
+    _verify(lfs_client, actions, upload_spec)
+    return True
+
+
+def _upload_part(lfs_client, file_obj, part, object_size, chunk_size):
+    pos = part.get('pos', 0)
+    section = FileSection(file_obj, pos, part.get('size') or object_size - pos, chunk_size)
+    headers = dict(part.get('header') or {})
+
+    if part.get('want_digest'):
+        headers.update(_section_digest_header(section, part['want_digest']))
+
+    for attempt in range(1, PART_ATTEMPTS + 1):
+        section.seek(0)
+        try:
+            response = lfs_client.session.request(
+                part.get('method', 'PUT'),
+                part['href'],
+                headers=headers,
+                data=section,
+                timeout=lfs_client.timeout
+            )
+            _raise_for_status(response, 'part upload')
+            return
+        except (requests.ConnectionError, requests.Timeout, LfsError) as e:
+            if attempt == PART_ATTEMPTS:
+                raise
+            log.warning(f"Retrying part at position {pos} after attempt {attempt} failed: {e}")
+
+
+def _section_digest_header(section, want_digest):
+    if want_digest != 'contentMD5':
+        raise RuntimeError(f"Don't know how to handle want_digest value: {want_digest}")
+
+    digest = hashlib.md5()
+    for chunk in section:
+        digest.update(chunk)
+    section.seek(0)
+    return {'Content-MD5': base64.b64encode(digest.digest()).decode('ascii')}
+
+
+def _send_action(lfs_client, action, name):
+    response = lfs_client.session.request(
+        action.get('method', 'POST'),
+        action['href'],
+        headers=action.get('header', {}),
+        data=action.get('body'),
+        timeout=lfs_client.timeout
+    )
+    _raise_for_status(response, name)
+
+
+def _verify(lfs_client, actions, upload_spec):
+    verify_action = actions.get('verify')
+
+    if verify_action:
+        response = lfs_client.session.post(
+            verify_action['href'],
+            headers=verify_action.get('header', {}),
+            json={'oid': upload_spec['oid'], 'size': upload_spec['size']},
+            timeout=lfs_client.timeout
+        )
+        _raise_for_status(response, 'verify')
+
+
+def _raise_for_status(response, name):
+    if response.status_code // 100 != 2:
+        raise LfsError(
+            f"Unexpected reply from LFS storage for {name}: {response.status_code} {response.text}",
+            status_code=response.status_code
+        )
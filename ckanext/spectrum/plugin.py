@@ -1,19 +1,22 @@
 import logging
 from collections import OrderedDict
 
+import sqlalchemy as sa
 import ckanext.blob_storage.helpers as blobstorage_helpers
 
 import ckan.lib.uploader as uploader
+import ckan.model as model
 import ckan.plugins as plugins
 import ckan.plugins.toolkit as toolkit
 import ckanext.spectrum.actions as spectrum_actions
 import ckanext.spectrum.authn as spectrum_authn
 import ckanext.spectrum.authz as spectrum_authz
+import ckanext.spectrum.lfs as spectrum_lfs
 import ckanext.spectrum.upload as spectrum_upload
 import ckanext.spectrum.validators as spectrum_validators
 from ckan.lib.plugins import DefaultPermissionLabels
 from ckanext.spectrum.helpers import (
-    get_dataset_from_id, get_facet_items_dict
+    get_dataset_from_id, get_datasets_from_ids, get_facet_items_dict
 )
 from ckan.common import config_declaration
 
@@ -39,6 +42,7 @@ class SpectrumPlugin(plugins.SingletonPlugin, DefaultPermissionLabels):
         return {
             u'max_resource_size': uploader.get_max_resource_size,
             u'get_dataset_from_id': get_dataset_from_id,
+            u'get_datasets_from_ids': get_datasets_from_ids,
             u'blob_storage_resource_filename': blobstorage_helpers.resource_filename,
             u'get_facet_items_dict': get_facet_items_dict
         }
@@ -58,6 +62,36 @@ class SpectrumPlugin(plugins.SingletonPlugin, DefaultPermissionLabels):
         """
         config_declaration.normalize(config)
 
+        spectrum_authn.substitute_user_cache.configure(
+            max_size=toolkit.asint(config.get('ckanext.spectrum.substitute_user_cache_size', 100)),
+            ttl=toolkit.asint(config.get('ckanext.spectrum.substitute_user_cache_ttl', 300))
+        )
+        spectrum_authn.route_matcher.configure(
+            sysadmin_only_patterns=toolkit.aslist(
+                config.get('ckanext.spectrum.sysadmin_only_paths', r'^/api/ /download/')
+            ),
+            exempt_patterns=toolkit.aslist(config.get('ckanext.spectrum.sysadmin_exempt_paths', ''))
+        )
+        spectrum_actions.default_organisation.configure(
+            config.get('ckanext.spectrum.default_organization', 'spectrum')
+        )
+        try:
+            spectrum_actions.default_organisation.get_id(model)
+        except sa.exc.SQLAlchemyError as e:
+            # e.g. the database isn't initialised yet, so look it up when first needed
+            model.Session.rollback()
+            log.warning(f"Could not look up the default organisation: {e}")
+        finally:
+            # Don't hold on to a connection, or hand the session to a forked worker
+            model.Session.remove()
+        spectrum_lfs.configure_session(
+            pool_size=toolkit.asint(config.get('ckanext.spectrum.lfs_pool_size', 10)),
+            timeout=(
+                toolkit.asint(config.get('ckanext.spectrum.lfs_connect_timeout', 10)),
+                toolkit.asint(config.get('ckanext.spectrum.lfs_read_timeout', 300))
+            )
+        )
+
     # IFacets
     def dataset_facets(self, facet_dict, package_type):
         new_fd = OrderedDict()
@@ -108,9 +142,27 @@ class SpectrumPlugin(plugins.SingletonPlugin, DefaultPermissionLabels):
         return {
             'user_list': spectrum_actions.user_list,
             'user_create': spectrum_actions.user_create,
+            'user_create_many': spectrum_actions.user_create_many,
+            'user_update': spectrum_actions.user_update,
+            'user_delete': spectrum_actions.user_delete,
             'dataset_duplicate': spectrum_actions.dataset_duplicate,
+            'dataset_duplicate_many': spectrum_actions.dataset_duplicate_many,
+            'dataset_delete_many': spectrum_actions.dataset_delete_many,
+            'resource_create_many': spectrum_actions.resource_create_many,
             'package_create': spectrum_actions.package_create,
-            'dataset_tag_replace': spectrum_actions.dataset_tag_replace
+            'package_collaborator_create': spectrum_actions.package_collaborator_create,
+            'package_collaborator_delete': spectrum_actions.package_collaborator_delete,
+            'organization_update': spectrum_actions.organization_update,
+            'organization_delete': spectrum_actions.organization_delete,
+            'organization_purge': spectrum_actions.organization_purge,
+            'organization_member_create': spectrum_actions.organization_member_create,
+            'organization_member_delete': spectrum_actions.organization_member_delete,
+            'dataset_tag_replace': spectrum_actions.dataset_tag_replace,
+            'dataset_tag_replace_status': spectrum_actions.dataset_tag_replace_status,
+            'activity_show': spectrum_actions.activity_show,
+            'activity_data_show': spectrum_actions.activity_data_show,
+            'activity_diff': spectrum_actions.activity_diff,
+            'spectrum_stats': spectrum_actions.spectrum_stats
         }
 
     # IValidators
@@ -121,13 +173,15 @@ class SpectrumPlugin(plugins.SingletonPlugin, DefaultPermissionLabels):
 
     # IPackageContoller
     def after_dataset_delete(self, context, data_dict):
-        package_data = toolkit.get_action('package_show')(context, data_dict)
-        if package_data.get('private'):
-            package_data['state'] = 'deleted'
-            context['package'].state = 'deleted'
-            spectrum_upload.add_activity(context, package_data, "changed")
+        package = context.get('package')
+        if not package or data_dict.get('id') not in (package.id, package.name):
+            package = model.Package.get(data_dict.get('id'))
+        if package and package.private:
+            package.state = 'deleted'
+            spectrum_upload.add_activity({**context, 'package': package}, {'name': package.name}, "changed")
 
     def after_dataset_update(self, context, data_dict):
+        spectrum_upload.forget_dataset_identity(data_dict.get('id'))
         if data_dict.get('private'):
             spectrum_upload.add_activity(context, data_dict, "changed")
 
@@ -145,7 +199,7 @@ class SpectrumPlugin(plugins.SingletonPlugin, DefaultPermissionLabels):
         username or user id of another CKAN user.
         """
 
-        if toolkit.request.path.startswith('/api/') or ('/download/' in toolkit.request.path):
+        if spectrum_authn.route_matcher.requires_sysadmin(toolkit.request.path):
             user_is_sysadmin = getattr(toolkit.current_user, 'sysadmin', False)
             if not user_is_sysadmin:
                 return {
@@ -0,0 +1,14 @@
+from flask import g, has_request_context
+
+
+def get_request_cache(name):
+    """
+    Returns the dict called name living for the duration of the current
+    request. Only memoize per request, as other requests and processes may
+    change the data in between. Outside of a request nothing is memoized.
+    """
+    if not has_request_context():
+        return {}
+    if not hasattr(g, name):
+        setattr(g, name, {})
+    return getattr(g, name)
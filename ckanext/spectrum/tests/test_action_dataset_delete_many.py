@@ -0,0 +1,58 @@
+import pytest
+
+import ckan.tests.factories as factories
+from ckan.tests.helpers import call_action
+from ckanext.spectrum.tests import get_context
+
+
+@pytest.fixture
+def datasets():
+    org = factories.Organization()
+    return [
+        factories.Dataset(owner_org=org['id'], private=private)
+        for private in [True, False, True]
+    ]
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestDatasetDeleteMany():
+
+    def test_datasets_deleted(self, datasets):
+        results = call_action('dataset_delete_many', ids=[d['id'] for d in datasets])
+        assert [r['success'] for r in results] == [True, True, True]
+        for dataset in datasets:
+            assert call_action('package_show', id=dataset['id'])['state'] == 'deleted'
+
+    def test_deleted_activities_recorded(self, datasets):
+        call_action('dataset_delete_many', ids=[d['name'] for d in datasets])
+        for dataset in datasets:
+            activities = call_action('package_activity_list', id=dataset['id'], include_hidden_activity=True)
+            assert activities[0]['activity_type'] == 'deleted package'
+
+    def test_missing_datasets_reported(self, datasets):
+        results = call_action('dataset_delete_many', ids=['non-existant-id', datasets[0]['id']])
+        assert [r['success'] for r in results] == [False, True]
+        assert results[0]['error']
+
+    def test_unauthorized_datasets_reported(self, datasets):
+        user = factories.User()
+        own_dataset = factories.Dataset(user=user)
+        results = call_action(
+            'dataset_delete_many',
+            context={**get_context(user), 'ignore_auth': False},
+            ids=[datasets[0]['id'], own_dataset['id']]
+        )
+        assert [r['success'] for r in results] == [False, True]
+        assert call_action('package_show', id=datasets[0]['id'])['state'] == 'active'
+
+    def test_own_dataset_does_not_authorize_later_datasets(self, datasets):
+        user = factories.User()
+        own_dataset = factories.Dataset(user=user)
+        results = call_action(
+            'dataset_delete_many',
+            context={**get_context(user), 'ignore_auth': False},
+            ids=[own_dataset['id'], datasets[0]['id'], datasets[1]['id']]
+        )
+        assert [r['success'] for r in results] == [True, False, False]
+        for dataset in datasets[:2]:
+            assert call_action('package_show', id=dataset['id'])['state'] == 'active'
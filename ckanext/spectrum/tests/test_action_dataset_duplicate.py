@@ -1,4 +1,6 @@
+import mock
 import pytest
+from sqlalchemy import orm
 
 import ckan.tests.factories as factories
 from ckan.plugins import toolkit
@@ -81,6 +83,57 @@ class TestDatasetDuplicate():
         result = call_action('dataset_duplicate', **data_dict)
         assert result[key] == value
 
+    @mock.patch('ckanext.spectrum.upload._get_authz_token', return_value='token')
+    @mock.patch('ckanext.spectrum.upload.blobstorage_helpers.server_url', return_value='http://giftless')
+    @mock.patch('ckanext.spectrum.upload.lfs.copy', return_value=1)
+    def test_stored_files_copied(self, mock_copy, mock_server_url, mock_token):
+        org = factories.Organization()
+        dataset = factories.Dataset(owner_org=org['id'])
+        factories.Resource(
+            package_id=dataset['id'],
+            url='data.csv',
+            url_type='upload',
+            sha256='abc',
+            size=10,
+            lfs_prefix=f"{org['name']}/{dataset['name']}"
+        )
+        factories.Resource(package_id=dataset['id'], url='http://link')
+
+        result = call_action('dataset_duplicate', id=dataset['id'], name="duplicated-dataset")
+
+        source_prefix, target_prefix, objects = mock_copy.call_args[0][2:5]
+        assert source_prefix == f"{org['name']}/{dataset['name']}"
+        assert target_prefix == f"{org['name']}/duplicated-dataset"
+        assert objects == [{'oid': 'abc', 'size': 10}]
+        assert result['resources'][0]['lfs_prefix'] == target_prefix
+        assert 'lfs_prefix' not in result['resources'][1]
+
+    def test_created_dataset_returned(self, dataset):
+        result = call_action('dataset_duplicate', id=dataset['id'], name="duplicated-dataset")
+        shown = call_action('package_show', id='duplicated-dataset')
+        assert result['id'] == shown['id']
+        assert [r['id'] for r in result['resources']] == [r['id'] for r in shown['resources']]
+        assert result['relationships_as_subject'] == shown['relationships_as_subject']
+        assert result['relationships_as_subject'][0]['type'] == 'child_of'
+
+    def test_duplication_recorded(self, dataset):
+        result = call_action('dataset_duplicate', id=dataset['id'], name="duplicated-dataset")
+        relationships = call_action('package_relationships_list', id=result['id'], id2=dataset['id'])
+        assert relationships[0]['type'] == 'child_of'
+        assert relationships[0]['comment'].startswith('Duplicated from activity ')
+
+    @pytest.mark.usefixtures('clean_index')
+    @pytest.mark.parametrize('private', [True, False])
+    @mock.patch('ckanext.spectrum.upload.copy_resource_objects', side_effect=RuntimeError('Storage unavailable'))
+    def test_failed_duplication_rolled_back(self, mock_copy, private):
+        dataset = factories.Dataset(owner_org=factories.Organization()['id'], private=private)
+        with pytest.raises(RuntimeError):
+            call_action('dataset_duplicate', id=dataset['id'], name="duplicated-dataset")
+        with pytest.raises(toolkit.ObjectNotFound):
+            call_action('package_show', id="duplicated-dataset")
+        found = call_action('package_search', fq='+name:duplicated-dataset', include_private=True)
+        assert found['count'] == 0
+
     def test_record_duplication(self):
         user = factories.User()
         dataset1 = factories.Dataset(user=user)
@@ -104,3 +157,76 @@ class TestDatasetDuplicate():
         assert relationships_list[0]['type'] == 'parent_of'
         assert relationships_list[0]['object'] == dataset2['name']
         assert relationships_list[0]['comment'].startswith('Duplicated from activity ')
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestDatasetDuplicateMany():
+
+    def test_datasets_duplicated(self, dataset):
+        other_dataset = factories.Dataset(owner_org=dataset['owner_org'])
+        results = call_action('dataset_duplicate_many', datasets=[
+            {'id': dataset['id'], 'name': 'duplicated-dataset'},
+            {'id': other_dataset['id'], 'name': 'other-duplicated-dataset', 'title': 'New title'}
+        ])
+        assert [r['success'] for r in results] == [True, True]
+        assert [r['id'] for r in results] == [dataset['id'], other_dataset['id']]
+        assert call_action('package_show', id='duplicated-dataset')['num_resources'] == 3
+        assert call_action('package_show', id='other-duplicated-dataset')['title'] == 'New title'
+
+    @pytest.mark.parametrize('batch_size', [1, 2, 10])
+    def test_failure_reported_without_undoing_others(self, dataset, batch_size):
+        results = call_action('dataset_duplicate_many', batch_size=batch_size, datasets=[
+            {'id': dataset['id'], 'name': 'duplicated-dataset'},
+            {'id': 'non-existant-id', 'name': 'missing-duplicated-dataset'},
+            {'id': dataset['id'], 'name': 'duplicated-dataset'},
+            {'id': dataset['id'], 'name': 'second-duplicated-dataset'}
+        ])
+        assert [r['success'] for r in results] == [True, False, False, True]
+        assert 'name' in results[2]['error']
+        for name in ['duplicated-dataset', 'second-duplicated-dataset']:
+            assert call_action('package_show', id=name)
+        with pytest.raises(toolkit.ObjectNotFound):
+            call_action('package_show', id='missing-duplicated-dataset')
+
+    @pytest.mark.usefixtures('clean_index')
+    def test_duplicates_indexed_despite_failure(self):
+        dataset = factories.Dataset(owner_org=factories.Organization()['id'], private=True)
+        results = call_action('dataset_duplicate_many', batch_size=10, datasets=[
+            {'id': dataset['id'], 'name': 'duplicated-dataset'},
+            {'id': 'non-existant-id', 'name': 'missing-duplicated-dataset'},
+            {'id': dataset['id'], 'name': 'second-duplicated-dataset'}
+        ])
+        assert [r['success'] for r in results] == [True, False, True]
+        found = call_action(
+            'package_search',
+            fq='+name:(duplicated-dataset OR second-duplicated-dataset)',
+            include_private=True
+        )
+        assert sorted(d['name'] for d in found['results']) == ['duplicated-dataset', 'second-duplicated-dataset']
+
+    def test_failed_batch_commit_reported_without_undoing_others(self, dataset):
+        session_commit = orm.Session.commit
+        errors = iter([RuntimeError('Database unavailable')])
+
+        def commit(session):
+            error = next(errors, None)
+            if error:
+                raise error
+            session_commit(session)
+
+        with mock.patch.object(orm.Session, 'commit', autospec=True, side_effect=commit):
+            results = call_action('dataset_duplicate_many', batch_size=1, datasets=[
+                {'id': dataset['id'], 'name': 'duplicated-dataset'},
+                {'id': dataset['id'], 'name': 'second-duplicated-dataset'}
+            ])
+
+        assert [r['success'] for r in results] == [False, True]
+        assert results[0]['error'] == 'Database unavailable'
+        assert call_action('package_show', id='second-duplicated-dataset')
+        with pytest.raises(toolkit.ObjectNotFound):
+            call_action('package_show', id='duplicated-dataset')
+
+    @pytest.mark.parametrize('datasets', [None, [], [{'name': 'no-id'}]])
+    def test_invalid_datasets(self, datasets):
+        with pytest.raises(toolkit.ValidationError):
+            call_action('dataset_duplicate_many', datasets=datasets)
@@ -1,8 +1,14 @@
 import pytest
 
+import ckan.lib.jobs as jobs
+import ckan.model as model
 import ckan.tests.factories as factories
 from ckan.plugins import toolkit
 from ckan.tests.helpers import call_action
+import ckanext.spectrum.activity as spectrum_activity
+from ckanext.activity.model import Activity
+from ckanext.spectrum.actions import _update_tags
+from ckanext.spectrum.jobs import JobProgress
 
 
 @pytest.mark.usefixtures('clean_db', 'with_plugins')
@@ -25,6 +31,187 @@ class TestDatasetTagPatch():
         assert_dataset_contains_only_tags(d2["id"], ["final", "covid19"])
         assert_dataset_contains_only_tags(d3["id"], ["covid19", "influenza"])
 
+    @pytest.mark.ckan_config('ckan.search.rows_max', 2)
+    def test_should_change_datasets_beyond_first_page_of_results(self):
+        datasets = [create_dataset(["draft"], f"d{i}") for i in range(5)]
+
+        result = call_action(
+            'dataset_tag_replace',
+            q='name:*',
+            tags={'draft': 'final'},
+            batch_size=2
+        )
+
+        assert result['datasets_modified'] == 5
+        assert [batch['datasets'] for batch in result['batches']] == [2, 2, 1]
+        for dataset in datasets:
+            assert_dataset_contains_only_tags(dataset["id"], ["final"])
+
+    def test_should_complain_when_invalid_batch_size_passed(self):
+        with pytest.raises(toolkit.ValidationError, match="batch_size"):
+            call_action(
+                'dataset_tag_replace',
+                q='name:*',
+                tags={'draft': 'final'},
+                batch_size=0
+            )
+
+    @pytest.mark.usefixtures('with_test_worker')
+    def test_should_change_tags_in_background_job(self):
+        d1 = create_dataset(["draft"], "d1")
+        d2 = create_dataset(["draft", "covid19"], "d2")
+        sysadmin = factories.Sysadmin()
+
+        result = call_action(
+            'dataset_tag_replace',
+            {'user': sysadmin['name']},
+            q='name:*',
+            tags={'draft': 'final'},
+            batch_size=1,
+            **{'async': True}
+        )
+        jobs.Worker().work(burst=True)
+
+        status = call_action(
+            'dataset_tag_replace_status',
+            {'user': sysadmin['name']},
+            id=result['job_id']
+        )
+        assert status['status'] == 'finished'
+        assert status['progress'] == {'scanned': 2, 'patched': 2, 'failed': 0}
+        assert status['result']['datasets_modified'] == 2
+        assert_dataset_contains_only_tags(d1["id"], ["final"])
+        assert_dataset_contains_only_tags(d2["id"], ["final", "covid19"])
+
+    @pytest.mark.usefixtures('with_test_worker')
+    def test_job_status_shown_to_the_user_who_started_it(self):
+        user = factories.User()
+        dataset = factories.Dataset(user=user, tags=[{'name': 'draft'}])
+        result = call_action(
+            'dataset_tag_replace',
+            {'user': user['name'], 'ignore_auth': False},
+            q='name:*',
+            tags={'draft': 'final'},
+            **{'async': True}
+        )
+        jobs.Worker().work(burst=True)
+
+        status = call_action(
+            'dataset_tag_replace_status',
+            {'user': user['name'], 'ignore_auth': False},
+            id=result['job_id']
+        )
+        assert status['progress'] == {'scanned': 1, 'patched': 1, 'failed': 0}
+        assert_dataset_contains_only_tags(dataset['id'], ['final'])
+
+        with pytest.raises(toolkit.NotAuthorized):
+            call_action(
+                'dataset_tag_replace_status',
+                {'user': factories.User()['name'], 'ignore_auth': False},
+                id=result['job_id']
+            )
+
+    def test_should_count_failed_datasets_individually(self):
+        d1 = create_dataset(["draft"], "d1")
+        d2 = create_dataset(["draft"], "d2")
+        datasets = [
+            {'id': d1['id'], 'tags': d1['tags']},
+            {'id': 'non-existent-id', 'tags': [{'name': 'draft'}]},
+            {'id': d2['id'], 'tags': d2['tags']}
+        ]
+        progress = JobProgress()
+
+        batches = _update_tags(
+            {'model': model, 'user': factories.Sysadmin()['name']},
+            datasets,
+            {'draft': 'final'},
+            batch_size=3,
+            progress=progress
+        )
+
+        assert progress.counts == {'scanned': 0, 'patched': 2, 'failed': 1}
+        assert batches[0]['datasets'] == 2
+        assert_dataset_contains_only_tags(d1["id"], ["final"])
+        assert_dataset_contains_only_tags(d2["id"], ["final"])
+
+    def test_should_roll_back_batch_when_a_dataset_fails(self):
+        d1 = create_dataset(["draft"], "d1")
+        datasets = [
+            {'id': d1['id'], 'tags': d1['tags']},
+            {'id': 'non-existent-id', 'tags': [{'name': 'draft'}]}
+        ]
+
+        with pytest.raises(toolkit.ObjectNotFound):
+            _update_tags(
+                {'model': model, 'user': factories.Sysadmin()['name']},
+                datasets,
+                {'draft': 'final'},
+                batch_size=2
+            )
+
+        assert_dataset_contains_only_tags(d1["id"], ["draft"])
+
+    def test_should_change_tags_directly_for_sysadmins(self):
+        d1 = create_dataset(["draft", "influenza"], "d1")
+        d2 = create_dataset(["consultations", "covid19"], "d2")
+        d3 = create_dataset(["draft", "consultations"], "d3")
+        sysadmin = factories.Sysadmin()
+
+        result = call_action(
+            'dataset_tag_replace',
+            {'user': sysadmin['name']},
+            q='name:*',
+            tags={'draft': 'consultations', 'consultations': 'final'},
+            direct=True
+        )
+
+        assert result['datasets_modified'] == 3
+        assert_dataset_contains_only_tags(d1["id"], ["influenza", "consultations"])
+        assert_dataset_contains_only_tags(d2["id"], ["final", "covid19"])
+        assert_dataset_contains_only_tags(d3["id"], ["consultations", "final"])
+        activities = call_action('package_activity_list', id=d1["id"])
+        assert activities[0]['activity_type'] == 'changed package'
+
+    @pytest.mark.ckan_config('ckanext.spectrum.compact_activities', 'true')
+    def test_should_compact_private_dataset_activities_when_changing_tags_directly(self):
+        sysadmin = factories.Sysadmin()
+        dataset = factories.Dataset(
+            owner_org=factories.Organization()['id'],
+            private=True,
+            tags=[{'name': 'draft'}],
+            resources=[{'name': f'resource-{i}', 'url': f'http://link/{i}'} for i in range(5)]
+        )
+
+        call_action(
+            'dataset_tag_replace',
+            {'user': sysadmin['name']},
+            q='name:*',
+            tags={'draft': 'final'},
+            direct=True,
+            include_private=True
+        )
+
+        activity = model.Session.query(Activity) \
+            .filter(Activity.object_id == dataset['id']) \
+            .order_by(Activity.timestamp.desc()) \
+            .first()
+        assert spectrum_activity.is_compact(activity)
+        shown = call_action('activity_show', {'user': sysadmin['name']}, id=activity.id)
+        assert [tag['name'] for tag in shown['data']['package']['tags']] == ['final']
+
+    def test_should_not_change_tags_directly_for_regular_users(self):
+        create_dataset(["draft"], "d1")
+        user = factories.User()
+
+        with pytest.raises(toolkit.NotAuthorized):
+            call_action(
+                'dataset_tag_replace',
+                {'user': user['name']},
+                q='name:*',
+                tags={'draft': 'final'},
+                direct=True
+            )
+
     def test_should_complain_when_no_tags_passed(self):
         with pytest.raises(toolkit.ValidationError) as ex:
             call_action(
@@ -0,0 +1,60 @@
+import pytest
+
+import ckan.tests.factories as factories
+from ckan.plugins import toolkit
+from ckan.tests.helpers import call_action
+
+
+@pytest.fixture
+def dataset():
+    org = factories.Organization()
+    dataset = factories.Dataset(owner_org=org['id'])
+    factories.Resource(package_id=dataset['id'], name='existing')
+    return call_action('package_show', id=dataset['id'])
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestResourceCreateMany():
+
+    def test_resources_created(self, dataset):
+        result = call_action(
+            'resource_create_many',
+            package_id=dataset['id'],
+            resources=[{'name': f'resource-{i}', 'url': f'http://test/{i}'} for i in range(3)]
+        )
+        assert [r['name'] for r in result] == ['resource-0', 'resource-1', 'resource-2']
+        updated = call_action('package_show', id=dataset['id'])
+        assert [r['name'] for r in updated['resources']] == ['existing'] + [r['name'] for r in result]
+
+    def test_resources_accepted_as_json(self, dataset):
+        result = call_action(
+            'resource_create_many',
+            package_id=dataset['id'],
+            resources='[{"name": "resource-0", "url": "http://test/0"}]'
+        )
+        assert result[0]['name'] == 'resource-0'
+
+    def test_single_dataset_revision(self, dataset):
+        activities_before = call_action('package_activity_list', id=dataset['id'])
+        call_action(
+            'resource_create_many',
+            package_id=dataset['id'],
+            resources=[{'name': f'resource-{i}', 'url': f'http://test/{i}'} for i in range(3)]
+        )
+        activities_after = call_action('package_activity_list', id=dataset['id'])
+        assert len(activities_after) == len(activities_before) + 1
+
+    @pytest.mark.parametrize('resources', [None, [], 'not-json', ['not-a-dict']])
+    def test_invalid_resources(self, dataset, resources):
+        with pytest.raises(toolkit.ValidationError):
+            call_action('resource_create_many', package_id=dataset['id'], resources=resources)
+
+    def test_unauthorized_user(self, dataset):
+        user = factories.User()
+        with pytest.raises(toolkit.NotAuthorized):
+            call_action(
+                'resource_create_many',
+                context={'user': user['name'], 'ignore_auth': False},
+                package_id=dataset['id'],
+                resources=[{'name': 'resource-0', 'url': 'http://test/0'}]
+            )
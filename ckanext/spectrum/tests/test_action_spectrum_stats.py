@@ -0,0 +1,35 @@
+import pytest
+
+import ckan.plugins.toolkit as toolkit
+import ckan.tests.factories as factories
+from ckan.tests.helpers import call_action
+from ckanext.spectrum.tests import get_context
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestSpectrumStats():
+
+    def test_route_classes_counted(self, app):
+        sysadmin = factories.Sysadmin()
+        counts_before = call_action('spectrum_stats', get_context(sysadmin))['routes']
+
+        app.get('/dataset/')
+
+        counts = call_action('spectrum_stats', get_context(sysadmin))['routes']
+        assert counts['other'] == counts_before['other'] + 1
+        assert counts['sysadmin_only'] == counts_before['sysadmin_only']
+
+    def test_substitute_user_cache_reported(self):
+        sysadmin = factories.Sysadmin()
+        stats = call_action('spectrum_stats', get_context(sysadmin))['substitute_user_cache']
+        assert set(stats) == {'hits', 'misses', 'size'}
+
+    def test_lfs_session_reported(self):
+        sysadmin = factories.Sysadmin()
+        stats = call_action('spectrum_stats', get_context(sysadmin))['lfs_session']
+        assert set(stats) == {'requests', 'connections', 'reused'}
+
+    def test_not_shown_to_other_users(self):
+        user = factories.User()
+        with pytest.raises(toolkit.NotAuthorized):
+            call_action('spectrum_stats', {**get_context(user), 'ignore_auth': False})
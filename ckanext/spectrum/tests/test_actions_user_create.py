@@ -2,9 +2,11 @@ import mock
 import pytest
 from zxcvbn import zxcvbn
 
+import ckan.model as model
 import ckan.tests.factories as factories
+from ckan.plugins.toolkit import ValidationError
 from ckan.tests.helpers import call_action
-from ckanext.spectrum.actions import user_create
+from ckanext.spectrum.actions import default_organisation, user_create
 from ckanext.spectrum.tests import get_context
 
 DUMMY_PASSWORD = '01234567890123456789012345678901'
@@ -104,4 +106,95 @@ class TestCreateUser():
         )
         assert response['password_hash']
 
+    def test_usernames_allocated_from_email(self):
+        factories.User(name='test-1')
+        factories.User(name='test-3')
+        factories.User(name='test-other')
+        names = [call_action('user_create', email='test@test.org')['name'] for i in range(2)]
+        assert names == ['test-2', 'test-4']
 
+    def test_username_reallocated_when_taken_concurrently(self, mock_token_urlsafe):
+        user = factories.User()
+        next_action = mock.Mock(side_effect=[
+            ValidationError({'name': ['That login name is not available.']}),
+            user
+        ])
+        context = get_context(user)
+        with mock.patch('ckanext.spectrum.actions._get_random_username_from_email',
+                        side_effect=['test-1', 'test-2']):
+            user_create(next_action, context, {'email': 'test@test.org'})
+        assert [c[0][1]['name'] for c in next_action.call_args_list] == ['test-1', 'test-2']
+
+    def test_given_username_not_reallocated(self, mock_token_urlsafe):
+        next_action = mock.Mock(side_effect=ValidationError({'name': ['That login name is not available.']}))
+        with pytest.raises(ValidationError):
+            user_create(next_action, get_context(factories.User()), {'name': 'taken', 'email': 'test@test.org'})
+        assert next_action.call_count == 1
+
+
+@pytest.mark.ckan_config('ckan.plugins', "spectrum")
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestCreateUsers():
+
+    def test_users_created(self, spectrum_org):
+        results = call_action('user_create_many', users=[
+            {'email': 'test@test.org'},
+            {'email': 'test@other.org'},
+            {'name': 'named-user', 'email': 'named@test.org'}
+        ])
+        assert [r['success'] for r in results] == [True, True, True]
+        assert [r['user']['name'] for r in results] == ['test-1', 'test-2', 'named-user']
+
+    def test_users_added_to_default_organisation(self, spectrum_org):
+        results = call_action('user_create_many', users=[
+            {'email': f'test{i}@test.org'} for i in range(3)
+        ])
+        members = call_action('member_list', id=spectrum_org['id'], object_type='user')
+        member_ids = {member[0]: member[2] for member in members}
+        for result in results:
+            assert member_ids[result['user']['id']] == 'editor'
+
+    def test_failures_reported_without_undoing_others(self, spectrum_org):
+        existing_user = factories.User()
+        results = call_action('user_create_many', users=[
+            {'email': 'first@test.org'},
+            {'id': existing_user['id'], 'email': 'taken-id@test.org'},
+            {'name': 'duplicate-name', 'email': 'duplicate1@test.org'},
+            {'name': 'duplicate-name', 'email': 'duplicate2@test.org'},
+            {'name': 'invalid name!', 'email': 'invalid@test.org'},
+            {},
+            {'email': 'last@test.org'}
+        ])
+        assert [r['success'] for r in results] == [True, False, True, False, False, False, True]
+        assert 'id' in results[1]['error']
+        assert 'name' in results[4]['error']
+        for name in ['first-1', 'duplicate-name', 'last-1']:
+            assert call_action('user_show', id=name)
+
+    def test_user_created_without_default_organisation(self):
+        results = call_action('user_create_many', users=[{'email': 'test@test.org'}])
+        assert results[0]['success']
+
+
+@pytest.mark.ckan_config('ckan.plugins', "spectrum")
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestDefaultOrganisation():
+
+    def test_id_looked_up_once(self, spectrum_org):
+        default_organisation.forget()
+        assert default_organisation.get_id(model) == spectrum_org['id']
+        with mock.patch.object(model.Session, 'query') as mock_query:
+            assert default_organisation.get_id(model) == spectrum_org['id']
+        mock_query.assert_not_called()
+
+    def test_id_forgotten_when_organisation_renamed(self, spectrum_org):
+        assert default_organisation.get_id(model) == spectrum_org['id']
+        call_action('organization_patch', id=spectrum_org['id'], name='renamed-org')
+        assert default_organisation.get_id(model) is None
+
+    def test_id_forgotten_when_organisation_deleted(self, spectrum_org):
+        assert default_organisation.get_id(model) == spectrum_org['id']
+        call_action('organization_delete', id=spectrum_org['id'])
+        assert default_organisation.get_id(model) is None
+        user = call_action('user_create', email='test@test.org')
+        assert user['name'] == 'test-1'
@@ -0,0 +1,150 @@
+import pytest
+
+from ckan.tests import factories
+from ckan.tests.helpers import call_action
+from ckanext.activity.model import Activity
+from ckanext.spectrum import activity
+from ckanext.spectrum.tests import get_context
+
+
+OLD_PACKAGE = {
+    'id': 'dataset-id',
+    'title': 'Old title',
+    'notes': 'Some notes',
+    'organization': {'id': 'org-id', 'name': 'org'},
+    'resources': [
+        {'id': 'resource-0', 'name': 'first', 'size': 1},
+        {'id': 'resource-1', 'name': 'second', 'size': 2}
+    ],
+    'extras': [{'key': 'a', 'value': '1'}]
+}
+NEW_PACKAGE = {
+    'id': 'dataset-id',
+    'title': 'New title',
+    'organization': {'id': 'org-id', 'name': 'renamed-org'},
+    'resources': [
+        {'id': 'resource-2', 'name': 'third', 'size': 3},
+        {'id': 'resource-0', 'name': 'first', 'size': 10}
+    ],
+    'extras': [{'key': 'a', 'value': '2'}],
+    'version': '2'
+}
+
+
+class TestDiff():
+
+    @pytest.mark.parametrize('old, new', [
+        (OLD_PACKAGE, NEW_PACKAGE),
+        (NEW_PACKAGE, OLD_PACKAGE),
+        (OLD_PACKAGE, OLD_PACKAGE),
+        ({}, NEW_PACKAGE),
+    ])
+    def test_patch_restores_new_dict(self, old, new):
+        assert activity.patch(old, activity.diff(old, new)) == new
+
+    def test_only_changes_stored(self):
+        changes = activity.diff(OLD_PACKAGE, NEW_PACKAGE)
+        assert changes['unset'] == ['notes']
+        assert changes['set'] == {
+            'title': 'New title',
+            'extras': [{'key': 'a', 'value': '2'}],
+            'version': '2'
+        }
+        assert changes['patch']['organization'] == {'set': {'name': 'renamed-org'}}
+        assert changes['patch']['resources'] == {
+            'ids': ['resource-2', 'resource-0'],
+            'set': {'resource-2': {'id': 'resource-2', 'name': 'third', 'size': 3}},
+            'patch': {'resource-0': {'set': {'size': 10}}}
+        }
+
+    def test_old_dict_not_modified(self):
+        old = dict(OLD_PACKAGE, resources=[dict(r) for r in OLD_PACKAGE['resources']])
+        activity.patch(old, activity.diff(OLD_PACKAGE, NEW_PACKAGE))
+        assert old == OLD_PACKAGE
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+@pytest.mark.ckan_config('ckanext.spectrum.compact_activities', 'true')
+@pytest.mark.ckan_config('ckanext.spectrum.activity_snapshot_interval', '3')
+class TestCompactActivities():
+
+    def _create_and_update_private_dataset(self, user, updates):
+        dataset = call_action(
+            'package_create',
+            get_context(user['name']),
+            name='compact-dataset',
+            private=True,
+            owner_org=factories.Organization()['id'],
+            resources=[{'name': f'resource-{i}', 'url': f'http://link/{i}'} for i in range(5)]
+        )
+        packages = [call_action('package_show', id=dataset['id'])]
+        for i in range(updates):
+            call_action('package_patch', get_context(user['name']), id=dataset['id'], notes=f'version {i}')
+            packages.append(call_action('package_show', id=dataset['id']))
+        activities = call_action('package_activity_list', get_context(user['name']), id=dataset['id'])
+        return packages, list(reversed(activities))
+
+    def test_full_snapshot_stored_every_interval(self):
+        user = factories.User()
+        packages, activities = self._create_and_update_private_dataset(user, 4)
+        compacted = [activity.COMPACT_KEY in a['data'] for a in activities]
+        assert compacted == [False, True, True, False, True]
+
+    def test_stream_shows_projection(self):
+        user = factories.User()
+        packages, activities = self._create_and_update_private_dataset(user, 1)
+        assert activities[1]['data']['package'] == activity.project(packages[1])
+
+    def test_stream_projection_keeps_resources(self):
+        user = factories.User()
+        packages, activities = self._create_and_update_private_dataset(user, 1)
+        resources = activities[1]['data']['package']['resources']
+        assert [(r['id'], r['url']) for r in resources] == [(r['id'], r['url']) for r in packages[1]['resources']]
+
+    def test_resource_history_shown(self, app):
+        user = factories.Sysadmin()
+        packages, activities = self._create_and_update_private_dataset(user, 1)
+        resource = packages[1]['resources'][0]
+        response = app.get(
+            f"/dataset/{packages[1]['id']}/resources/{resource['id']}/history/{activities[1]['id']}",
+            extra_environ={'REMOTE_USER': user['name']}
+        )
+        assert resource['name'] in response.body
+
+    def test_activity_show_reconstructs_package(self):
+        user = factories.User()
+        packages, activities = self._create_and_update_private_dataset(user, 4)
+        for package, activity_dict in zip(packages, activities):
+            shown = call_action('activity_show', get_context(user['name']), id=activity_dict['id'])
+            assert shown['data']['package'] == package
+            assert activity.COMPACT_KEY not in shown['data']
+
+    def test_activity_data_show_reconstructs_package(self):
+        user = factories.User()
+        packages, activities = self._create_and_update_private_dataset(user, 2)
+        package = call_action(
+            'activity_data_show',
+            get_context(user['name']),
+            id=activities[-1]['id'],
+            object_type='package'
+        )
+        assert package == packages[-1]
+
+    def test_activity_diff_compares_full_packages(self):
+        user = factories.User()
+        packages, activities = self._create_and_update_private_dataset(user, 2)
+        result = call_action(
+            'activity_diff',
+            get_context(user['name']),
+            id=activities[-1]['id'],
+            object_type='package'
+        )
+        assert [a['data']['package'] for a in result['activities']] == packages[-2:]
+        assert '"version 1"' in result['diff']
+        assert 'resource-4' not in result['diff']
+
+    def test_stored_activity_not_overwritten(self):
+        user = factories.User()
+        packages, activities = self._create_and_update_private_dataset(user, 1)
+        call_action('activity_show', get_context(user['name']), id=activities[-1]['id'])
+        assert activity.is_compact(Activity.get(activities[-1]['id']))
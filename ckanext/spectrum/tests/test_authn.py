@@ -1,6 +1,10 @@
+import mock
 import pytest
 import ckan.plugins.toolkit as toolkit
+from ckan import model
 from ckan.tests import factories
+from ckan.tests.helpers import call_action
+from ckanext.spectrum.authn import RouteMatcher, SubstituteUserCache, substitute_user_cache
 
 
 @pytest.mark.ckan_config('ckan.plugins', "spectrum scheming_datasets")
@@ -119,3 +123,88 @@ class TestSubstituteUser():
         )
         assert response.status_code == 200
         assert response.json['result']['creator_user_id'] == substitute_user['id']
+
+    def test_substitute_user_is_cached(self, app):
+        sysadmin_user = factories.UserWithToken(sysadmin=True)
+        substitute_user = factories.User()
+        substitute_user_cache.invalidate(substitute_user['id'])
+
+        with mock.patch('ckanext.spectrum.authn.model.User.get', wraps=model.User.get) as user_get:
+            for i in range(2):
+                response = app.get(
+                    toolkit.url_for('api.action', ver=3, logic_function='package_list'),
+                    headers={
+                        'Authorization': sysadmin_user['token'],
+                        'CKAN-Substitute-User': substitute_user['name']
+                    }
+                )
+                assert response.status_code == 200
+
+        lookups = [c for c in user_get.call_args_list if c[0] == (substitute_user['name'],)]
+        assert len(lookups) == 1
+
+    def test_cached_substitute_user_invalidated_on_update(self):
+        user = factories.User()
+        substitute_user_cache.set(user['name'], {'id': user['id'], 'name': user['name']})
+        call_action('user_patch', id=user['id'], fullname='New Name')
+        assert substitute_user_cache.get(user['name']) is None
+
+
+class TestRouteMatcher():
+
+    @pytest.mark.parametrize('path, requires_sysadmin', [
+        ('/api/3/action/package_list', True),
+        ('/dataset/test/resource/test/download/file.pjnz', True),
+        ('/', False),
+        ('/dataset/test', False),
+        ('/webassets/spectrum/spectrum.css', False),
+        ('/base/images/ckan-logo.png', False)
+    ])
+    def test_default_sysadmin_only_paths(self, path, requires_sysadmin):
+        assert RouteMatcher().requires_sysadmin(path) == requires_sysadmin
+
+    def test_exempt_paths(self):
+        matcher = RouteMatcher(exempt_patterns=[r'^/api/i18n/'])
+        assert not matcher.requires_sysadmin('/api/i18n/en')
+        assert matcher.requires_sysadmin('/api/3/action/package_list')
+        assert not matcher.requires_sysadmin('/dataset')
+        assert matcher.stats() == {'sysadmin_only': 1, 'exempt': 1, 'other': 1}
+
+    @pytest.mark.ckan_config('ckanext.spectrum.sysadmin_exempt_paths', '^/api/i18n/')
+    @pytest.mark.usefixtures('clean_db', 'with_plugins')
+    def test_exempt_paths_configured(self, app):
+        response = app.get('/api/i18n/en')
+        assert response.status_code == 200
+
+
+class TestSubstituteUserCache():
+
+    def test_cached_by_name_and_id(self):
+        cache = SubstituteUserCache()
+        cache.set('test-user', {'id': 'test-id', 'name': 'test-user'})
+        assert cache.get('test-user') == cache.get('test-id') == {'id': 'test-id', 'name': 'test-user'}
+        assert cache.stats() == {'hits': 2, 'misses': 0, 'size': 1}
+
+    def test_least_recently_used_user_evicted(self):
+        cache = SubstituteUserCache(max_size=2)
+        cache.set('user-1', {'id': 'id-1', 'name': 'user-1'})
+        cache.set('user-2', {'id': 'id-2', 'name': 'user-2'})
+        cache.get('user-1')
+        cache.set('user-3', {'id': 'id-3', 'name': 'user-3'})
+        assert cache.get('user-2') is None
+        assert cache.get('user-1')
+        assert cache.get('user-3')
+
+    def test_expired_user_not_returned(self):
+        cache = SubstituteUserCache(ttl=10)
+        with mock.patch('ckanext.spectrum.authn.time.monotonic', return_value=0):
+            cache.set('test-user', {'id': 'test-id', 'name': 'test-user'})
+        with mock.patch('ckanext.spectrum.authn.time.monotonic', return_value=11):
+            assert cache.get('test-user') is None
+        assert cache.stats() == {'hits': 0, 'misses': 1, 'size': 0}
+
+    def test_invalidated_by_id(self):
+        cache = SubstituteUserCache()
+        cache.set('test-user', {'id': 'test-id', 'name': 'test-user'})
+        cache.invalidate('test-id')
+        assert cache.get('test-user') is None
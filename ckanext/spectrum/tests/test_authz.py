@@ -1,8 +1,10 @@
+import mock
 import pytest
 
 from ckan.plugins import toolkit
 from ckan.tests import factories
 from ckan.tests.helpers import call_auth, call_action
+from ckanext.spectrum.authz import package_update_bulk
 from ckanext.spectrum.tests import get_context
 
 
@@ -163,3 +165,55 @@ class TestAuth():
             id=datasets[0]['id'],
             user_id=users[1]['id']
         )
+
+    def test_bulk_update_check_allows_only_own_datasets(self, users, datasets):
+        dataset_ids = [dataset['id'] for dataset in datasets]
+        allowed, denied = package_update_bulk(get_context(users[0]), dataset_ids)
+        assert allowed == [datasets[0]['id']]
+        assert denied == [datasets[1]['id'], datasets[2]['id']]
+
+    def test_bulk_update_check_allows_editor_collaborators(self, users, datasets):
+        call_action(
+            'package_collaborator_create',
+            id=datasets[0]['id'],
+            user_id=users[1]['id'],
+            capacity='editor'
+        )
+        dataset_ids = [dataset['id'] for dataset in datasets]
+        allowed, denied = package_update_bulk(get_context(users[1]), dataset_ids)
+        assert allowed == dataset_ids
+        assert denied == []
+
+    @pytest.mark.usefixtures("with_request_context")
+    def test_collaborator_checks_are_memoized_per_request(self, users, datasets):
+        with mock.patch(
+            'ckanext.spectrum.authz.authz.user_is_collaborator_on_dataset',
+            return_value=True
+        ) as mock_is_collaborator:
+            for i in range(3):
+                assert call_auth(
+                    'package_update',
+                    get_context(users[1]),
+                    id=datasets[0]['id']
+                )
+        mock_is_collaborator.assert_called_once()
+
+    @pytest.mark.usefixtures("with_request_context")
+    def test_memoized_collaborator_checks_cleared_when_collaborators_change(self, users, datasets):
+        with pytest.raises(toolkit.NotAuthorized):
+            call_auth(
+                'package_update',
+                get_context(users[1]),
+                id=datasets[0]['id']
+            )
+        call_action(
+            'package_collaborator_create',
+            id=datasets[0]['id'],
+            user_id=users[1]['id'],
+            capacity='editor'
+        )
+        assert call_auth(
+            'package_update',
+            get_context(users[1]),
+            id=datasets[0]['id']
+        )
@@ -0,0 +1,92 @@
+import mock
+import pytest
+
+from ckan.tests import factories
+from ckanext.spectrum import helpers
+
+
+@pytest.mark.usefixtures('clean_db', 'clean_index', 'with_plugins', 'with_request_context')
+class TestGetDatasetsFromIds():
+
+    def test_summaries_returned_in_order(self):
+        org = factories.Organization()
+        datasets = [factories.Dataset(owner_org=org['id'], private=True) for i in range(3)]
+        ids = [datasets[2]['id'], datasets[0]['name'], datasets[1]['id']]
+
+        summaries = helpers.get_datasets_from_ids(ids)
+
+        assert [s['id'] for s in summaries] == [datasets[2]['id'], datasets[0]['id'], datasets[1]['id']]
+        assert summaries[0] == {
+            'id': datasets[2]['id'],
+            'name': datasets[2]['name'],
+            'title': datasets[2]['title'],
+            'type': 'dataset',
+            'state': 'active',
+            'organization': org['name'],
+            'private': True,
+            'metadata_modified': summaries[0]['metadata_modified']
+        }
+
+    def test_datasets_not_found_left_out(self):
+        dataset = factories.Dataset()
+        summaries = helpers.get_datasets_from_ids(['non-existent-id', dataset['id']])
+        assert [s['id'] for s in summaries] == [dataset['id']]
+
+    def test_ids_cannot_widen_the_search(self):
+        factories.Dataset()
+        summaries = helpers.get_datasets_from_ids(['x") OR id:(*', 'x\\" OR name:*'])
+        assert summaries == []
+
+    def test_one_search_per_request(self):
+        datasets = [factories.Dataset() for i in range(3)]
+        package_search = mock.Mock(wraps=helpers.logic.get_action('package_search'))
+
+        with mock.patch('ckanext.spectrum.helpers.logic.get_action', return_value=package_search):
+            helpers.get_datasets_from_ids([ds['id'] for ds in datasets[:2]])
+            helpers.get_datasets_from_ids([ds['id'] for ds in datasets])
+            helpers.get_datasets_from_ids([ds['name'] for ds in datasets])
+
+        assert package_search.call_count == 2
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins', 'with_request_context')
+class TestGetDatasetFromId():
+
+    def test_dataset_shown_once_per_request(self):
+        dataset = factories.Dataset()
+        package_show = mock.Mock(wraps=helpers.logic.get_action('package_show'))
+
+        with mock.patch('ckanext.spectrum.helpers.logic.get_action', return_value=package_show):
+            results = [helpers.get_dataset_from_id(dataset['id']) for i in range(3)]
+
+        assert package_show.call_count == 1
+        assert results[0]['name'] == dataset['name']
+
+
+@pytest.mark.usefixtures('with_plugins')
+class TestGetFacetItemsDict():
+
+    search_facets = {
+        'tags': {'items': [
+            {'name': 'a', 'display_name': 'a', 'count': 1},
+            {'name': 'b', 'display_name': 'b', 'count': 2},
+            {'name': 'c', 'display_name': 'c', 'count': 3}
+        ]},
+        'country_name': {'items': [
+            {'name': 'a', 'display_name': 'a', 'count': 1}
+        ]}
+    }
+
+    def test_active_filters_marked(self, app):
+        with app.flask_app.test_request_context('/dataset/?tags=a&tags=c'):
+            tags = helpers.get_facet_items_dict('tags', self.search_facets)
+            countries = helpers.get_facet_items_dict('country_name', self.search_facets)
+
+        assert [(t['name'], t['active']) for t in tags] == [('c', True), ('b', False), ('a', True)]
+        assert [(c['name'], c['active']) for c in countries] == [('a', False)]
+
+    def test_active_filters_excluded(self, app):
+        with app.flask_app.test_request_context('/dataset/?tags=a&tags=c'):
+            tags = helpers.get_facet_items_dict('tags', self.search_facets, exclude_active=True)
+
+        assert [t['name'] for t in tags] == ['b']
@@ -0,0 +1,194 @@
+import hashlib
+import io
+
+import mock
+import pytest
+
+from ckanext.spectrum import lfs
+
+
+FILE_CONTENT = b'0123456789' * 10
+
+
+@pytest.fixture
+def file_obj():
+    return io.BytesIO(FILE_CONTENT)
+
+
+@pytest.fixture
+def mock_session():
+    response = mock.Mock(status_code=200)
+    return mock.Mock(**{
+        'put.return_value': response,
+        'post.return_value': response,
+        'request.return_value': response
+    })
+
+
+def lfs_client(transfer, actions, session):
+    client = mock.Mock(session=session, timeout=(1, 1))
+    client.batch.return_value = {
+        'transfer': transfer,
+        'objects': [{
+            'oid': hashlib.sha256(FILE_CONTENT).hexdigest(),
+            'size': len(FILE_CONTENT),
+            'actions': actions
+        }]
+    }
+    return client
+
+
+class TestLfsUpload():
+
+    def test_object_attributes_computed_in_chunks(self, file_obj):
+        attributes = lfs.get_object_attributes(file_obj, chunk_size=7)
+        assert attributes == {
+            'oid': hashlib.sha256(FILE_CONTENT).hexdigest(),
+            'size': len(FILE_CONTENT)
+        }
+        assert file_obj.tell() == 0
+
+    def test_file_section_reads_only_its_bytes(self, file_obj):
+        section = lfs.FileSection(file_obj, 10, 25, chunk_size=10)
+        assert len(section) == 25
+        assert list(section) == [FILE_CONTENT[10:20], FILE_CONTENT[20:30], FILE_CONTENT[30:35]]
+        section.seek(0)
+        assert section.read() == FILE_CONTENT[10:35]
+
+    def test_small_files_use_basic_transfer(self, file_obj, mock_session):
+        client = lfs_client('basic', {'upload': {'href': 'http://upload'}}, mock_session)
+        result = lfs.upload(client, file_obj, 'org', 'dataset')
+
+        assert result['size'] == len(FILE_CONTENT)
+        assert client.batch.call_args[1]['transfers'] == ['basic']
+        section = mock_session.put.call_args[1]['data']
+        assert section.read() == FILE_CONTENT
+
+    def test_large_files_use_multipart_transfer(self, file_obj, mock_session):
+        client = lfs_client('multipart-basic', {
+            'parts': [
+                {'href': 'http://part1', 'pos': 0, 'size': 60},
+                {'href': 'http://part2', 'pos': 60, 'size': 40, 'want_digest': 'contentMD5'}
+            ],
+            'commit': {'href': 'http://commit'}
+        }, mock_session)
+        lfs.upload(client, file_obj, 'org', 'dataset', multipart_threshold=50)
+
+        assert client.batch.call_args[1]['transfers'] == ['multipart-basic', 'basic']
+        part_urls = [c[0][1] for c in mock_session.request.call_args_list]
+        assert part_urls == ['http://part1', 'http://part2', 'http://commit']
+        assert 'Content-MD5' in mock_session.request.call_args_list[1][1]['headers']
+
+    def test_failed_parts_are_retried(self, file_obj, mock_session):
+        failure = mock.Mock(status_code=500, text='error')
+        success = mock.Mock(status_code=200)
+        mock_session.request.side_effect = [failure, success]
+        client = lfs_client('multipart-basic', {
+            'parts': [{'href': 'http://part1', 'pos': 0, 'size': 100}]
+        }, mock_session)
+        lfs.upload(client, file_obj, 'org', 'dataset', multipart_threshold=50)
+        assert mock_session.request.call_count == 2
+
+    def test_existing_objects_not_transferred(self, file_obj, mock_session):
+        client = lfs_client('basic', {}, mock_session)
+        result = lfs.upload(client, file_obj, 'org', 'dataset')
+        mock_session.put.assert_not_called()
+        assert result['transferred'] is False
+        assert result['oid'] == hashlib.sha256(FILE_CONTENT).hexdigest()
+
+    def test_given_object_attributes_not_recomputed(self, file_obj, mock_session):
+        client = lfs_client('basic', {'upload': {'href': 'http://upload'}}, mock_session)
+        object_attrs = {'oid': 'precomputed', 'size': len(FILE_CONTENT)}
+        with mock.patch('ckanext.spectrum.lfs.get_object_attributes') as mock_attributes:
+            result = lfs.upload(client, file_obj, 'org', 'dataset', object_attrs=object_attrs)
+        mock_attributes.assert_not_called()
+        assert client.batch.call_args[0][2] == [object_attrs]
+        assert result['transferred'] is True
+
+
+class TestPooledLfsClient():
+
+    def test_session_shared_between_clients(self):
+        lfs.configure_session(pool_size=5, timeout=(1, 2))
+        clients = [lfs.PooledLfsClient('http://giftless') for i in range(2)]
+        assert clients[0].session is clients[1].session
+        assert clients[0].timeout == (1, 2)
+        assert clients[0].session.get_adapter('https://giftless')._pool_maxsize == 5
+
+    def test_batch_sent_through_session(self):
+        client = lfs.PooledLfsClient('http://giftless/', auth_token='token')
+        with mock.patch.object(client, 'session') as mock_session:
+            mock_session.post.return_value.status_code = 200
+            client.batch('org/dataset', 'upload', [{'oid': 'abc', 'size': 1}])
+        url = mock_session.post.call_args[0][0]
+        kwargs = mock_session.post.call_args[1]
+        assert url == 'http://giftless/org/dataset/objects/batch'
+        assert kwargs['headers']['Authorization'] == 'Bearer token'
+        assert kwargs['json']['transfers'] == ['basic']
+
+    def test_session_stats_start_empty(self):
+        lfs.configure_session(pool_size=5, timeout=(1, 2))
+        lfs.get_session()
+        assert lfs.session_stats() == {'requests': 0, 'connections': 0, 'reused': 0}
+
+
+AZURE_UPLOAD_HREF = 'https://account.blob.core.windows.net/container/abc?sig=signature'
+
+
+class TestLfsCopy():
+
+    def clients(self, mock_session, upload_actions):
+        target = mock.Mock(session=mock_session, timeout=(1, 1))
+        target.batch.return_value = {'objects': [
+            {'oid': oid, 'size': 10, 'actions': actions} for oid, actions in upload_actions.items()
+        ]}
+        source = mock.Mock(session=mock_session, timeout=(1, 1))
+        source.batch.side_effect = lambda prefix, operation, objects: {'objects': [
+            {**obj, 'actions': {'download': {'href': f"http://download/{obj['oid']}"}}} for obj in objects
+        ]}
+        return source, target
+
+    def test_objects_copied_server_side(self, mock_session):
+        source, target = self.clients(mock_session, {'abc': {'upload': {'href': AZURE_UPLOAD_HREF}}})
+        copied = lfs.copy(source, target, 'org/source', 'org/target', [{'oid': 'abc', 'size': 10}] * 2)
+
+        assert copied == 1
+        assert target.batch.call_args[0] == ('org/target', 'upload', [{'oid': 'abc', 'size': 10}])
+        headers = mock_session.put.call_args[1]['headers']
+        assert headers['x-ms-copy-source'] == 'http://download/abc'
+        mock_session.get.assert_not_called()
+
+    def test_existing_objects_not_copied(self, mock_session):
+        source, target = self.clients(mock_session, {'abc': {}})
+        copied = lfs.copy(source, target, 'org/source', 'org/target', [{'oid': 'abc', 'size': 10}])
+
+        assert copied == 0
+        source.batch.assert_not_called()
+        mock_session.put.assert_not_called()
+
+    def test_objects_streamed_when_server_side_copy_fails(self, mock_session):
+        failure = mock.Mock(status_code=403, text='error')
+        success = mock.Mock(status_code=200)
+        mock_session.put.side_effect = [failure, success]
+        download = mock.MagicMock(status_code=200)
+        download.__enter__.return_value = download
+        mock_session.get.return_value = download
+        source, target = self.clients(mock_session, {'abc': {'upload': {'href': AZURE_UPLOAD_HREF}}})
+        lfs.copy(source, target, 'org/source', 'org/target', [{'oid': 'abc', 'size': 10}])
+
+        assert mock_session.get.call_args[0][0] == 'http://download/abc'
+        streamed = mock_session.put.call_args[1]['data']
+        assert len(streamed) == 10
+        assert streamed.response is download
+
+    def test_objects_streamed_to_other_storage(self, mock_session):
+        mock_session.put.return_value = mock.Mock(status_code=200)
+        download = mock.MagicMock(status_code=200)
+        download.__enter__.return_value = download
+        mock_session.get.return_value = download
+        source, target = self.clients(mock_session, {'abc': {'upload': {'href': 'http://upload/abc'}}})
+        lfs.copy(source, target, 'org/source', 'org/target', [{'oid': 'abc', 'size': 10}])
+
+        assert mock_session.put.call_count == 1
+        assert 'x-ms-copy-source' not in mock_session.put.call_args[1]['headers']
+        assert mock_session.get.call_args[0][0] == 'http://download/abc'
@@ -1,5 +1,7 @@
 import pytest
 
+from ckan import model
+from ckan.plugins import toolkit
 from ckan.tests import factories
 from ckan.tests.helpers import call_action
 from ckanext.spectrum.tests import get_context
@@ -62,3 +64,17 @@ class TestPrivateDatasetActivities():
             id=private_dataset['id']
         )
         assert len(activity_stream) == 1
+
+    def test_activity_written_in_same_commit_as_dataset(self):
+        user = factories.User()
+        context = {**get_context(user['name']), 'defer_commit': True}
+        result = call_action(
+            'package_create',
+            context,
+            name="uncommitted-dataset",
+            private=True,
+            owner_org=factories.Organization()['id']
+        )
+        model.Session.rollback()
+        with pytest.raises(toolkit.ObjectNotFound):
+            call_action('package_activity_list', get_context(user['name']), id=result['id'])
@@ -0,0 +1,176 @@
+import hashlib
+import io
+import time
+
+import jwt
+import mock
+import pytest
+
+from ckan import model
+from ckan.plugins import toolkit
+from ckan.tests import factories
+from ckan.tests.helpers import call_action
+from werkzeug.datastructures import FileStorage
+from ckanext.spectrum import upload
+
+
+def authz_result(expires_in):
+    token = jwt.encode({'exp': int(time.time()) + expires_in}, 'a-test-secret-of-at-least-32-bytes', algorithm='HS256')
+    return {'token': token, 'granted_scopes': ['obj:org/dataset/*:write']}
+
+
+@pytest.fixture
+def mock_authorize():
+    upload.clear_authz_token_cache()
+    authorize = mock.Mock(return_value=authz_result(600))
+    with mock.patch('ckanext.spectrum.upload.toolkit.get_action', return_value=authorize):
+        yield authorize
+    upload.clear_authz_token_cache()
+
+
+class TestUploadAuthzToken():
+
+    def test_token_reused_for_same_user_and_scope(self, mock_authorize):
+        tokens = [
+            upload._get_upload_authz_token({'user': 'test-user'}, 'dataset', 'org')
+            for i in range(3)
+        ]
+        assert mock_authorize.call_count == 1
+        assert len(set(tokens)) == 1
+
+    @pytest.mark.parametrize('context, dataset_name', [
+        ({'user': 'other-user'}, 'dataset'),
+        ({'user': 'test-user'}, 'other-dataset'),
+    ])
+    def test_token_not_reused_for_other_user_or_scope(self, mock_authorize, context, dataset_name):
+        upload._get_upload_authz_token({'user': 'test-user'}, 'dataset', 'org')
+        upload._get_upload_authz_token(context, dataset_name, 'org')
+        assert mock_authorize.call_count == 2
+
+    def test_token_not_cached_when_ignoring_auth(self, mock_authorize):
+        upload._get_upload_authz_token({'user': 'test-user', 'ignore_auth': True}, 'dataset', 'org')
+        upload._get_upload_authz_token({'user': 'test-user'}, 'dataset', 'org')
+        upload._get_upload_authz_token({'user': 'test-user', 'ignore_auth': True}, 'dataset', 'org')
+        assert mock_authorize.call_count == 3
+
+    def test_token_not_reused_close_to_expiry(self, mock_authorize):
+        mock_authorize.return_value = authz_result(30)
+        for i in range(2):
+            upload._get_upload_authz_token({'user': 'test-user'}, 'dataset', 'org')
+        assert mock_authorize.call_count == 2
+
+    def test_token_not_reused_beyond_max_age(self, mock_authorize):
+        upload._get_upload_authz_token({'user': 'test-user'}, 'dataset', 'org')
+        with mock.patch('ckanext.spectrum.upload.time.time', return_value=time.time() + 61):
+            upload._get_upload_authz_token({'user': 'test-user'}, 'dataset', 'org')
+        assert mock_authorize.call_count == 2
+
+    def test_token_not_reused_after_cache_cleared(self, mock_authorize):
+        upload._get_upload_authz_token({'user': 'test-user'}, 'dataset', 'org')
+        upload.clear_authz_token_cache()
+        upload._get_upload_authz_token({'user': 'test-user'}, 'dataset', 'org')
+        assert mock_authorize.call_count == 2
+
+
+class TestUploadMany():
+
+    @mock.patch('ckanext.spectrum.upload.blobstorage_helpers')
+    @mock.patch('ckanext.spectrum.upload.get_dataset_identity', return_value=('dataset', 'org'))
+    @mock.patch('ckanext.spectrum.upload.lfs.upload')
+    def test_files_uploaded_with_one_token(self, mock_upload, mock_identity, mock_helpers, mock_authorize):
+        mock_upload.side_effect = lambda client, file_obj, *args, **kwargs: {
+            'oid': file_obj.read().decode(), 'size': 1
+        }
+        resources = [
+            {'name': 'file-0', 'upload': FileStorage(io.BytesIO(b'a'), filename='a.csv')},
+            {'name': 'link', 'url': 'http://link'},
+            {'name': 'file-1', 'upload': FileStorage(io.BytesIO(b'b'), filename='b.csv')}
+        ]
+        upload.handle_giftless_uploads_many({'user': 'test-user'}, 'dataset-id', resources)
+
+        assert mock_authorize.call_count == 1
+        assert mock_upload.call_count == 2
+        assert [r.get('sha256') for r in resources] == ['a', None, 'b']
+        assert [r['url'] for r in resources] == ['a.csv', 'http://link', 'b.csv']
+        assert not any('upload' in r for r in resources)
+
+    @mock.patch('ckanext.spectrum.upload.blobstorage_helpers')
+    @mock.patch('ckanext.spectrum.upload.get_dataset_identity', return_value=('dataset', 'org'))
+    @mock.patch('ckanext.spectrum.upload.lfs.upload')
+    def test_identical_files_uploaded_once(self, mock_upload, mock_identity, mock_helpers, mock_authorize):
+        mock_upload.side_effect = lambda client, file_obj, *args, object_attrs=None, **kwargs: object_attrs
+        resources = [
+            {'name': 'first', 'upload': FileStorage(io.BytesIO(b'same'), filename='first.csv')},
+            {'name': 'second', 'upload': FileStorage(io.BytesIO(b'same'), filename='second.csv')}
+        ]
+        upload.handle_giftless_uploads_many({'user': 'test-user'}, 'dataset-id', resources)
+
+        assert mock_upload.call_count == 1
+        assert resources[0]['sha256'] == resources[1]['sha256']
+        assert [r['url'] for r in resources] == ['first.csv', 'second.csv']
+
+
+class TestUploadDeduplication():
+
+    @mock.patch('ckanext.spectrum.upload.blobstorage_helpers.resource_storage_prefix', return_value='org/dataset')
+    @mock.patch('ckanext.spectrum.upload.get_dataset_identity', return_value=('dataset', 'org'))
+    @mock.patch('ckanext.spectrum.upload.lfs.upload')
+    def test_unchanged_file_not_uploaded(self, mock_upload, mock_identity, mock_prefix, mock_authorize):
+        current = {
+            'id': 'resource-id',
+            'package_id': 'dataset-id',
+            'url_type': 'upload',
+            'url': 'data.csv',
+            'sha256': hashlib.sha256(b'data').hexdigest(),
+            'size': 4,
+            'lfs_prefix': 'org/dataset',
+            'last_modified': 'then'
+        }
+        resource = dict(current, upload=FileStorage(io.BytesIO(b'data'), filename='data.csv'))
+        upload.handle_giftless_uploads({'user': 'test-user'}, resource, current=current)
+
+        mock_upload.assert_not_called()
+        mock_authorize.assert_not_called()
+        assert resource['sha256'] == current['sha256']
+        assert resource['last_modified'] == 'then'
+
+    @mock.patch('ckanext.spectrum.upload.blobstorage_helpers')
+    @mock.patch('ckanext.spectrum.upload.get_dataset_identity', return_value=('dataset', 'org'))
+    @mock.patch('ckanext.spectrum.upload.lfs.upload')
+    def test_changed_file_uploaded(self, mock_upload, mock_identity, mock_helpers, mock_authorize):
+        mock_upload.side_effect = lambda client, file_obj, *args, object_attrs=None, **kwargs: object_attrs
+        mock_helpers.resource_storage_prefix.return_value = 'org/dataset'
+        current = {
+            'package_id': 'dataset-id',
+            'url_type': 'upload',
+            'sha256': 'old-sha256',
+            'size': 4,
+            'lfs_prefix': 'org/dataset'
+        }
+        resource = dict(current, upload=FileStorage(io.BytesIO(b'data'), filename='data.csv'))
+        upload.handle_giftless_uploads({'user': 'test-user'}, resource, current=current)
+
+        assert mock_upload.call_count == 1
+        assert resource['sha256'] == hashlib.sha256(b'data').hexdigest()
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins', 'with_request_context')
+class TestDatasetIdentity():
+
+    @pytest.mark.parametrize('key', ['id', 'name'])
+    def test_identity_found_by_id_or_name(self, key):
+        org = factories.Organization()
+        dataset = factories.Dataset(owner_org=org['id'])
+        identity = upload.get_dataset_identity({'model': model}, dataset[key])
+        assert identity == (dataset['name'], org['name'])
+
+    def test_identity_forgotten_when_dataset_renamed(self):
+        dataset = factories.Dataset(owner_org=factories.Organization()['id'])
+        upload.get_dataset_identity({'model': model}, dataset['id'])
+        call_action('package_patch', id=dataset['id'], name='renamed-dataset')
+        identity = upload.get_dataset_identity({'model': model}, dataset['id'])
+        assert identity[0] == 'renamed-dataset'
+
+    def test_identity_not_found(self):
+        with pytest.raises(toolkit.ObjectNotFound):
+            upload.get_dataset_identity({'model': model}, 'non-existant-id')
@@ -1,4 +1,5 @@
 import re
+import string
 
 import mock
 import pytest
@@ -67,11 +68,27 @@ class TestAutoGenerateNameFromTitle(object):
         assert dataset3["name"] == dataset2["name"]
 
     @mock.patch("ckanext.spectrum.validators.choice", return_value="a")
-    def test_many_failed_generation_attempts(self, mock_choice):
+    def test_repeated_random_ids_still_unique(self, mock_choice):
+        names = [self._create_dataset()["name"] for i in range(4)]
+        assert names == [
+            "north-pole-projection",
+            "north-pole-projection-aaa",
+            "north-pole-projection-aab",
+            "north-pole-projection-aac"
+        ]
+
+    @mock.patch("ckanext.spectrum.validators.ALPHA_ID_LENGTH", 1)
+    def test_longer_ids_used_when_all_short_ids_taken(self):
         self._create_dataset()
-        self._create_dataset()
-        with pytest.raises(ValidationError, match="Could not autogenerate"):
-            self._create_dataset()
+        for letter in string.ascii_lowercase:
+            self._create_dataset(name=f"north-pole-projection-{letter}")
+        dataset = self._create_dataset()
+        assert re.fullmatch("north-pole-projection-[a-z]{2}", dataset["name"])
+
+    def test_names_sharing_prefix_ignored(self):
+        self._create_dataset(name="north-pole-projection-extended")
+        dataset = self._create_dataset()
+        assert dataset["name"] == "north-pole-projection"
 
     def test_missing_title(self):
         with pytest.raises(ValidationError, match="title.*Missing value"):
@@ -1,22 +1,47 @@
 import datetime
 import logging
-from giftless_client import LfsClient
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import jwt
+import sqlalchemy as sa
 from werkzeug.datastructures import FileStorage as FlaskFileStorage
 import ckanext.blob_storage.helpers as blobstorage_helpers
 from ckanext.activity.model import Activity
 import ckan.plugins.toolkit as toolkit
+import ckanext.spectrum.activity as spectrum_activity
+import ckanext.spectrum.lfs as lfs
+from ckanext.spectrum.request_cache import get_request_cache
 
 
 log = logging.getLogger(__name__)
 
+_authz_tokens = {}
+_authz_tokens_lock = threading.Lock()
+
 
 def add_activity(context, data_dict, activity_type):
-    user = context['model'].User.by_name(context['user'])
+    """
+    Adds the activity to the session without committing it, so that it is
+    written in the same commit as the dataset change it records. CKAN's
+    package actions commit after calling the IPackageController hooks.
+
+    With ckanext.spectrum.compact_activities enabled, the activity stores
+    the changes since the dataset's previous activity rather than a full
+    snapshot of the package.
+    """
+    model = context['model']
+    user = context.get('auth_user_obj')
+    if getattr(user, 'name', None) != context['user']:
+        user = model.User.by_name(context['user'])
     user_id = getattr(user, 'id', "UnknownUser")
-    package = context.get("package", context['model'].Package.get(data_dict["name"]))
+    package = context.get("package") or model.Package.get(data_dict["name"])
     activity = Activity.activity_stream_item(package, activity_type, user_id)
-    context['session'].add(activity)
-    context["session"].commit()
+    # None if a deleted activity has already been recorded
+    if activity:
+        if spectrum_activity.compacts_activities():
+            spectrum_activity.compact(model, activity)
+        context['session'].add(activity)
 
 
 def handle_giftless_uploads(context, resource, current=None):
@@ -24,6 +49,131 @@ def handle_giftless_uploads(context, resource, current=None):
     _update_resource_last_modified_date(resource, current=current)
 
 
+def handle_giftless_uploads_many(context, dataset_id, resources):
+    """
+    Uploads the files attached to several new resources of one dataset,
+    requesting a single authorization token and transferring the files
+    concurrently in a bounded thread pool. Files with identical content
+    are only transferred once.
+    """
+    attached_files = [(resource, resource.pop('upload', None)) for resource in resources]
+    attached_files = [
+        (resource, attached_file) for resource, attached_file in attached_files
+        if isinstance(attached_file, FlaskFileStorage)
+    ]
+
+    if not attached_files:
+        return
+
+    dataset_name, org_name = get_dataset_identity(context, dataset_id)
+    lfs_client = _get_lfs_client(context, dataset_name, org_name)
+    max_workers = toolkit.asint(toolkit.config.get('ckanext.spectrum.upload_max_workers', 4))
+
+    with ThreadPoolExecutor(max_workers=max(min(max_workers, len(attached_files)), 1)) as executor:
+        all_object_attrs = list(executor.map(
+            lambda attached: lfs.get_object_attributes(attached[1], _upload_chunk_size()),
+            attached_files
+        ))
+        uploads = {}
+        for (resource, attached_file), object_attrs in zip(attached_files, all_object_attrs):
+            if object_attrs['oid'] not in uploads:
+                uploads[object_attrs['oid']] = executor.submit(
+                    _upload_file, lfs_client, attached_file, dataset_name, org_name, object_attrs
+                )
+
+    for (resource, attached_file), object_attrs in zip(attached_files, all_object_attrs):
+        uploaded = uploads[object_attrs['oid']].result()
+        resource.update(uploaded, url=attached_file.filename)
+
+
+def copy_resource_objects(context, dataset_id, resources):
+    """
+    Copies the stored objects of a dataset's uploaded resources, wherever
+    they currently live, into the dataset's own storage namespace and
+    returns its lfs_prefix, or None if no resource has a stored object.
+    """
+    resources = [
+        resource for resource in resources
+        if resource.get('url_type') == 'upload' and resource.get('sha256') and resource.get('lfs_prefix')
+    ]
+
+    if not resources:
+        return None
+
+    dataset_name, org_name = get_dataset_identity(context, dataset_id)
+    target_prefix = blobstorage_helpers.resource_storage_prefix(dataset_name, org_name=org_name)
+    target_client = _get_lfs_client(context, dataset_name, org_name)
+
+    objects_by_prefix = {}
+    for resource in resources:
+        if resource['lfs_prefix'] != target_prefix:
+            objects_by_prefix.setdefault(resource['lfs_prefix'], []).append(
+                {'oid': resource['sha256'], 'size': resource['size']}
+            )
+
+    for source_prefix, objects in objects_by_prefix.items():
+        source_client = lfs.PooledLfsClient(
+            lfs_server_url=blobstorage_helpers.server_url(),
+            auth_token=_get_authz_token(
+                context,
+                'obj:{}/*:read'.format(source_prefix),
+                "You are not authorized to read the files of this dataset."
+            )
+        )
+        copied = lfs.copy(
+            source_client,
+            target_client,
+            source_prefix,
+            target_prefix,
+            objects,
+            max_workers=toolkit.asint(toolkit.config.get('ckanext.spectrum.upload_max_workers', 4)),
+            server_side=toolkit.asbool(toolkit.config.get('ckanext.spectrum.server_side_copy', True)),
+            chunk_size=_upload_chunk_size()
+        )
+        log.info(f"Copied {copied} of {len(objects)} objects from {source_prefix} to {target_prefix}")
+
+    return target_prefix
+
+
+def get_dataset_identity(context, dataset_id):
+    """
+    Returns the name and organization name of a dataset, which is all an
+    upload needs, with a single query rather than a full package_show.
+    The result is memoized for the rest of the request.
+    """
+    cache = _dataset_identity_cache()
+
+    if dataset_id not in cache:
+        model = context['model']
+        dataset = model.Session.query(model.Package.id, model.Package.name, model.Group.name) \
+            .outerjoin(model.Group, model.Group.id == model.Package.owner_org) \
+            .filter(sa.or_(model.Package.id == dataset_id, model.Package.name == dataset_id)) \
+            .first()
+
+        if not dataset:
+            raise toolkit.ObjectNotFound(toolkit._('Dataset not found'))
+
+        cache[dataset_id] = tuple(dataset)
+
+    return cache[dataset_id][1:]
+
+
+def forget_dataset_identity(dataset_id):
+    """
+    Drops a memoized dataset identity, e.g. because the dataset was renamed
+    or moved to another organization.
+    """
+    cache = _dataset_identity_cache()
+
+    for key in [key for key, identity in cache.items() if dataset_id in (key, identity[0])]:
+        del cache[key]
+
+
+def _dataset_identity_cache():
+    # Only memoized per request, as other processes may rename datasets
+    return get_request_cache('spectrum_dataset_identities')
+
+
 def _giftless_upload(context, resource, current=None):
     attached_file = resource.pop('upload', None)
 
@@ -35,39 +185,82 @@ def _giftless_upload(context, resource, current=None):
             if not dataset_id:
                 dataset_id = current['package_id']
 
-            dataset = toolkit.get_action('package_show')(
-                context, {'id': dataset_id}
-            )
-            dataset_name = dataset['name']
-            org_name = dataset.get('organization', {}).get('name')
-            authz_token = _get_upload_authz_token(
-                context,
-                dataset_name,
-                org_name
-            )
-            lfs_client = LfsClient(
-                lfs_server_url=blobstorage_helpers.server_url(),
-                auth_token=authz_token,
-                transfer_adapters=['basic']
-            )
-            uploaded_file = lfs_client.upload(
-                file_obj=attached_file,
-                organization=org_name,
-                repo=dataset_name
-            )
-            lfs_prefix = blobstorage_helpers.resource_storage_prefix(
-                dataset_name,
-                org_name=org_name
-            )
+            dataset_name, org_name = get_dataset_identity(context, dataset_id)
+            object_attrs = lfs.get_object_attributes(attached_file, _upload_chunk_size())
+
+            if _is_current_object(current, object_attrs, dataset_name, org_name):
+                log.info(f"Resource {current.get('id')} already holds object {object_attrs['oid']}, skipping upload")
+                resource.update(_object_fields(attached_file, object_attrs, dataset_name, org_name))
+                return
+
+            lfs_client = _get_lfs_client(context, dataset_name, org_name)
+            resource.update(_upload_file(lfs_client, attached_file, dataset_name, org_name, object_attrs))
+
+
+def _is_current_object(current, object_attrs, dataset_name, org_name):
+    """
+    Whether the resource being updated already points at the uploaded
+    content, in which case neither a token nor a transfer is needed.
+    """
+    if not current or current.get('url_type') != 'upload':
+        return False
+
+    return current.get('sha256') == object_attrs['oid'] \
+        and str(current.get('size')) == str(object_attrs['size']) \
+        and current.get('lfs_prefix') == blobstorage_helpers.resource_storage_prefix(dataset_name, org_name=org_name)
+
+
+def _get_lfs_client(context, dataset_name, org_name):
+    authz_token = _get_upload_authz_token(
+        context,
+        dataset_name,
+        org_name
+    )
+    return lfs.PooledLfsClient(
+        lfs_server_url=blobstorage_helpers.server_url(),
+        auth_token=authz_token
+    )
+
+
+def _upload_file(lfs_client, attached_file, dataset_name, org_name, object_attrs=None):
+    uploaded_file = lfs.upload(
+        lfs_client,
+        attached_file,
+        org_name,
+        dataset_name,
+        chunk_size=_upload_chunk_size(),
+        multipart_threshold=toolkit.asint(
+            toolkit.config.get('ckanext.spectrum.multipart_upload_threshold', lfs.MULTIPART_THRESHOLD)
+        ),
+        object_attrs=object_attrs
+    )
+
+    if not uploaded_file.get('transferred', True):
+        log.info(f"Object {uploaded_file['oid']} already exists in storage, skipped transfer")
+
+    return dict(
+        _object_fields(attached_file, uploaded_file, dataset_name, org_name),
+        last_modified=datetime.datetime.utcnow()
+    )
+
+
+def _object_fields(attached_file, object_attrs, dataset_name, org_name):
+    lfs_prefix = blobstorage_helpers.resource_storage_prefix(
+        dataset_name,
+        org_name=org_name
+    )
 
-            resource.update({
-                'url_type': 'upload',
-                'last_modified': datetime.datetime.utcnow(),
-                'sha256': uploaded_file['oid'],
-                'size': uploaded_file['size'],
-                'url': attached_file.filename,
-                'lfs_prefix': lfs_prefix
-            })
+    return {
+        'url_type': 'upload',
+        'sha256': object_attrs['oid'],
+        'size': object_attrs['size'],
+        'url': attached_file.filename,
+        'lfs_prefix': lfs_prefix
+    }
+
+
+def _upload_chunk_size():
+    return toolkit.asint(toolkit.config.get('ckanext.spectrum.upload_chunk_size', lfs.CHUNK_SIZE))
 
 
 def _update_resource_last_modified_date(resource, current=None):
@@ -84,8 +277,32 @@ def _update_resource_last_modified_date(resource, current=None):
             return
 
 
+def clear_authz_token_cache():
+    """
+    Forgets all cached upload authorization tokens. Must be called whenever
+    changes are made that could alter which scopes a user is granted.
+    """
+    with _authz_tokens_lock:
+        _authz_tokens.clear()
+
+
 def _get_upload_authz_token(context, dataset_name, org_name):
-    scope = 'obj:{}/{}/*:write'.format(org_name, dataset_name)
+    return _get_authz_token(
+        context,
+        'obj:{}/{}/*:write'.format(org_name, dataset_name),
+        "You are not authorized to upload this resource."
+    )
+
+
+def _get_authz_token(context, scope, error):
+    # Tokens granted while ignoring auth must not serve the user's other requests
+    use_cache = not context.get('ignore_auth')
+    cache_key = (context.get('user'), scope)
+    cached_token = _get_cached_authz_token(cache_key) if use_cache else None
+
+    if cached_token:
+        return cached_token
+
     authorize = toolkit.get_action('authz_authorize')
 
     if not authorize:
@@ -99,9 +316,44 @@ def _get_upload_authz_token(context, dataset_name, org_name):
         raise RuntimeError("Failed to get authorization token for LFS server")
 
     if len(authz_result['granted_scopes']) == 0:
-        error = "You are not authorized to upload this resource."
         log.error(error)
         raise toolkit.NotAuthorized(error)
 
+    if use_cache:
+        _cache_authz_token(cache_key, authz_result['token'])
+
     return authz_result['token']
 
+
+def _get_cached_authz_token(cache_key):
+    with _authz_tokens_lock:
+        token, valid_until = _authz_tokens.get(cache_key, (None, 0))
+
+    if valid_until > time.time():
+        return token
+
+
+def _cache_authz_token(cache_key, token):
+    """
+    Caches the token until its expiry time, less a safety margin so that it
+    can't expire part way through an upload, but for no longer than the
+    maximum age. The cache is only cleared in the process making a change
+    to a user's scopes, so the maximum age bounds how long other worker
+    processes may keep using a token granted before the change.
+    """
+    if not cache_key[0]:
+        return
+
+    try:
+        expires_at = jwt.decode(token, options={'verify_signature': False})['exp']
+    except (jwt.InvalidTokenError, KeyError):
+        return
+
+    margin = toolkit.asint(toolkit.config.get('ckanext.spectrum.authz_token_expiry_margin', 60))
+    max_age = toolkit.asint(toolkit.config.get('ckanext.spectrum.authz_token_cache_max_age', 60))
+    now = time.time()
+
+    with _authz_tokens_lock:
+        for expired_key in [key for key, (_, valid_until) in _authz_tokens.items() if valid_until <= now]:
+            del _authz_tokens[expired_key]
+        _authz_tokens[cache_key] = (token, min(expires_at - margin, now + max_age))
@@ -1,12 +1,15 @@
 from ckanext.scheming.validation import scheming_validator
-from ckan.logic.validators import package_name_validator
-from ckan.plugins.toolkit import ValidationError, _
+from ckan.plugins.toolkit import ValidationError
 from string import ascii_lowercase
 from random import choice
-import copy
+import itertools
+import sqlalchemy as sa
 import slugify
 
 
+ALPHA_ID_LENGTH = 3
+
+
 @scheming_validator
 def generate_name_from_title(field, schema):
 
@@ -25,21 +28,53 @@ def generate_name_from_title(field, schema):
             raise ValidationError({'title': ['Missing value']})
 
         title_slug = slugify.slugify(data[('title',)])
-        data[key] = title_slug
+        data[key] = _generate_unique_name(title_slug, context)
+
+    return validator
 
-        # Multiple attempts so alpha_id can be as short as possible
-        for counter in range(10):
-            package_name_errors = copy.deepcopy(errors)
-            package_name_validator(key, data, package_name_errors, context)
-            dataset_name_valid = package_name_errors[key] == errors[key]
 
-            if dataset_name_valid:
-                break
+def _generate_unique_name(title_slug, context):
+    """
+    Returns the title slug if it is free, and otherwise the slug with the
+    shortest free random alphabetic suffix, using a single query for all
+    names already taken.
+    """
+    taken_names = _get_taken_names(title_slug, context)
 
-            alpha_id = ''.join(choice(ascii_lowercase) for i in range(3))
-            new_dataset_name = "{}-{}".format(title_slug, alpha_id)
-            data[key] = new_dataset_name
-        else:
-            raise ValidationError({'name': [_('Could not autogenerate a unique name.')]})
+    if title_slug not in taken_names:
+        return title_slug
 
-    return validator
+    prefix = title_slug + '-'
+
+    for length in itertools.count(ALPHA_ID_LENGTH):
+        taken_ids = {
+            name[len(prefix):] for name in taken_names
+            if name.startswith(prefix) and len(name) == len(prefix) + length
+        }
+
+        if len(taken_ids) >= len(ascii_lowercase) ** length:
+            continue
+
+        alpha_id = ''.join(choice(ascii_lowercase) for i in range(length))
+
+        # Rather than guessing again, take the first free id when crowded
+        if alpha_id in taken_ids:
+            alpha_id = next(
+                alpha_id for alpha_id in map(''.join, itertools.product(ascii_lowercase, repeat=length))
+                if alpha_id not in taken_ids
+            )
+
+        return prefix + alpha_id
+
+
+def _get_taken_names(title_slug, context):
+    model = context['model']
+    escaped_slug = title_slug.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    names = context['session'].query(model.Package.name).filter(
+        sa.or_(
+            model.Package.name == title_slug,
+            model.Package.name.like(escaped_slug + '-%', escape='\\')
+        ),
+        model.Package.state != model.State.DELETED
+    )
+    return {name for name, in names}